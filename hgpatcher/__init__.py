@@ -1,8 +1,183 @@
 from StringIO import StringIO
+import threading
 import patch
 
-def apply_patch(the_patch, original_str):
+def apply_patch(the_patch, original_str, stats=None, reverse=False,
+                locate=False, eol='\n'):
+    """Apply a single-file patch to 'original_str' and return the result.
+
+    'stats' is an optional stats.patchstats, told about every hunk
+    applied, and every hunk parsed unless the patch came from the cache.
+    With 'reverse' set, the patch is undone instead, rolling a patched
+    text back to the original. Set 'locate' when the original drifted
+    far from what the patch expects: all hunks are then looked for in a
+    single scan of it. Line endings of the result are 'eol', or kept as
+    they were with 'keep'. A patch removing the file gives ''. Raises
+    PatchError if any hunk fails.
+    """
     targetfile = StringIO(original_str)
     changed = {}
-    patch.applydiff_hacked(the_patch, targetfile, changed)
+    patch.applydiff_hacked(the_patch, targetfile, changed, eol=eol,
+                           ui=patch.patchui(stats), reverse=reverse,
+                           locate=locate)
     return targetfile.getvalue()
+
+def check_patch(the_patch, original_str, reverse=False):
+    """Tell whether a single-file patch applies to 'original_str',
+    without building the result.
+
+    Returns a stats.hunkstat per hunk; its status() is 'exact',
+    'offset', 'fuzz' or 'failed', 'position' the line it applies at and
+    'offset' how far that is from where the hunk said it would be.
+    """
+    ui = patch.UIDummy()
+    gitpatches, files = patch.hunkcache.readpatch(ui, the_patch,
+                                                  textmode=True,
+                                                  reverse=reverse)
+    return patch.checkparsed(ui, gitpatches, files, StringIO(original_str))
+
+_executor = None
+_executorlock = threading.Lock()
+
+def apply_patch_async(the_patch, original_str, timeout=None, executor=None):
+    """Apply a single-file patch in the background.
+
+    Returns a background.pendingpatch at once; see its result(),
+    cancel() and add_done_callback() methods. The patch runs on
+    'executor', a background.patchexecutor, or on a shared one of four
+    threads. 'timeout' is in seconds, from now.
+    """
+    global _executor
+    if executor is None:
+        _executorlock.acquire()
+        try:
+            if _executor is None:
+                import background
+                _executor = background.patchexecutor()
+            executor = _executor
+        finally:
+            _executorlock.release()
+    return executor.submit(the_patch, original_str, timeout)
+
+def apply_series(patches, original_str, checkpoints=None):
+    """Apply a stack of single-file patches, each on top of the previous
+    one, and return the final text.
+
+    'patches' holds patch strings or compiled patches. The document is
+    split into lines once for the whole series. Each key of the dict
+    'checkpoints' is an index in 'patches'; the text right after that
+    patch is stored under it.
+    """
+    ui = patch.UIDummy()
+    def parsed():
+        for p in patches:
+            if isinstance(p, patch.compiledpatch):
+                yield p.gitpatches, p.files
+            else:
+                yield patch.hunkcache.readpatch(ui, p, textmode=True)
+    targetfile = StringIO(original_str)
+    patch.applyseries(ui, parsed(), targetfile, checkpoints=checkpoints)
+    return targetfile.getvalue()
+
+def compose_patches(patches):
+    """Squash a list of single-file patches, each made against the
+    output of the previous one, into a single patch and return its
+    text. The original is not needed.
+
+    'patches' holds patch strings or compiled patches. Raises
+    patch.PatchConflict if a patch changes lines other than those the
+    previous ones left; see mdiff.compose().
+    """
+    import mdiff
+    ui = patch.UIDummy()
+    hunks = []
+    names = None
+    for p in patches:
+        if isinstance(p, patch.compiledpatch):
+            files = p.files
+        else:
+            gitpatches, files = patch.hunkcache.readpatch(ui, p,
+                                                          textmode=True)
+        if len(files) > 1:
+            raise ValueError('Expected only one file!')
+        if not files:
+            continue
+        afile, bfile, phunks = files[0]
+        if names is None:
+            names = [afile, bfile]
+            hunks = list(phunks)
+        else:
+            names[1] = bfile
+            hunks = mdiff.compose(hunks, phunks)
+    if names is None:
+        return ''
+    return mdiff.writepatch(hunks, *names)
+
+def apply_batch(pairs, workers=None, chunksize=64, ordered=True):
+    """Apply many (patch, original) pairs on a process pool, yielding a
+    background.batchresult for each, in order unless 'ordered' is False.
+    Failures are reported in the results instead of raised."""
+    import background
+    return background.applybatch(pairs, workers, chunksize, ordered)
+
+def iter_patch(the_patch, original, window=100):
+    """Apply a single-file patch to 'original', an iterable of lines
+    such as an open file, and yield the patched text in chunks.
+
+    Hunks must apply in order, without fuzz and within 'window' lines
+    of their stated position; only that window is held in memory.
+    """
+    ui = patch.UIDummy()
+    gitpatches, parsed = patch.hunkcache.readpatch(ui, the_patch,
+                                                   textmode=True)
+    if len(parsed) > 1:
+        raise ValueError('Expected only one file!')
+    hunks = parsed and parsed[0][2] or ()
+    return patch.iterpatched(ui, hunks, original, window=window)
+
+def apply_patch_buffer(the_patch, buf, fp=None):
+    """Apply a single-file patch to a str, mmap or memoryview without
+    splitting it into lines.
+
+    Line endings are compared as they are. The result is written to the
+    file object 'fp', or returned as a str if there is none.
+    """
+    ui = patch.UIDummy()
+    gitpatches, parsed = patch.hunkcache.readpatch(ui, the_patch)
+    if len(parsed) > 1:
+        raise ValueError('Expected only one file!')
+    hunks = parsed and parsed[0][2] or ()
+    return patch.applybuffer(ui, hunks, buf, fp)
+
+def compile_patch(the_patch):
+    """Parse 'the_patch' once and return a patch.compiledpatch, whose
+    apply(), apply_many() and apply_files() methods skip parsing."""
+    return patch.compiledpatch(the_patch)
+
+def make_patch(original_str, new_str, context=3):
+    """Return a unified diff turning 'original_str' into 'new_str',
+    with 'context' unchanged lines around each change."""
+    import mdiff
+    return mdiff.unidiff(original_str, new_str, context=context)
+
+def compile_diff(original_str, new_str, context=3):
+    """Diff 'original_str' and 'new_str' into a patch.compiledpatch,
+    without writing and parsing diff text. Line endings are part of the
+    lines, so the patch keeps those of 'new_str'."""
+    import mdiff
+    parsed = mdiff.diffparsed(original_str, new_str, context=context)
+    return patch.compiledpatch(None, eol=None, parsed=parsed)
+
+def apply_patch_files(the_patch, files, strip=1, workers=None, pool=None):
+    """Apply a multi-file patch to the {path: content} dict 'files'.
+
+    Returns a new dict with the patched, created, renamed and removed
+    files. Each file is patched as a separate job on 'pool' (anything
+    with a map() method, e.g. a multiprocessing.Pool or ThreadPool),
+    or on a new process pool of 'workers' processes.
+    """
+    ui = patch.UIDummy()
+    gitpatches, parsed = patch.hunkcache.readpatch(ui, the_patch,
+                                                   textmode=True)
+    return patch.applyfilemap(ui, gitpatches, parsed, files, strip,
+                              workers=workers, pool=pool)
@@ -0,0 +1,315 @@
+# background.py - apply patches off the calling thread
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""Apply patches in worker threads or processes.
+
+Event loops must not block on a big patch. patchexecutor.submit()
+returns at once with a pendingpatch, whose callbacks run when the patch
+is done; hand the result back to the loop with its thread-safe call
+(loop.call_soon_threadsafe(), reactor.callFromThread(), ...).
+
+applybatch() spreads large batches of patches over a process pool.
+"""
+
+import threading, Queue
+from StringIO import StringIO
+from timeit import default_timer as timer
+
+import patch
+from patch import PatchCancelled, PatchTimeout
+
+class pendingpatch(object):
+    """A patch submitted to a patchexecutor"""
+    def __init__(self, the_patch, original, timeout=None):
+        self.the_patch = the_patch
+        self.original = original
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = timer() + timeout
+        self.state = 'pending'
+        self._result = None
+        self._exc = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.isSet()
+
+    def cancelled(self):
+        return self.state == 'cancelled'
+
+    def cancel(self):
+        """Cancel the patch. A pending patch never runs; a running one
+        stops before its next hunk. Returns False if it is done."""
+        self._lock.acquire()
+        try:
+            if self._done.isSet():
+                return False
+            if self.state == 'running':
+                self.state = 'cancelling'
+                return True
+        finally:
+            self._lock.release()
+        self._finish(None, PatchCancelled(), 'cancelled')
+        return True
+
+    def check(self):
+        """raise if the patch should stop, called between hunks"""
+        if self.state in ('cancelling', 'cancelled'):
+            raise PatchCancelled()
+        if self.deadline is not None and timer() > self.deadline:
+            raise PatchTimeout()
+
+    def start(self):
+        self._lock.acquire()
+        try:
+            if self.state != 'pending':
+                return False
+            self.state = 'running'
+            return True
+        finally:
+            self._lock.release()
+
+    def _finish(self, result, exc, state='done'):
+        self._lock.acquire()
+        try:
+            if self._done.isSet():
+                return
+            if self.state == 'cancelling':
+                # could not be stopped, drop what it gave
+                result, exc = None, PatchCancelled()
+            elif (exc is None and self.deadline is not None and
+                  timer() > self.deadline):
+                result, exc = None, PatchTimeout()
+            if isinstance(exc, PatchCancelled):
+                state = 'cancelled'
+            self._result = result
+            self._exc = exc
+            self.state = state
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            fn(self)
+
+    def add_done_callback(self, fn):
+        """call fn(self) once the patch is done, from the thread that
+        finishes it, or right away if it already is"""
+        self._lock.acquire()
+        try:
+            if not self._done.isSet():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exc
+
+    def result(self, timeout=None):
+        """Wait up to 'timeout' seconds and return the patched string.
+        Raises the patching error, PatchCancelled or PatchTimeout."""
+        self._wait(timeout)
+        if self._exc is not None:
+            raise self._exc
+        return self._result
+
+    def _wait(self, timeout):
+        if self.deadline is not None:
+            left = max(self.deadline - timer(), 0)
+            if timeout is None or left < timeout:
+                timeout = left
+        # Event.wait() without a timeout cannot be interrupted
+        if timeout is None:
+            while not self._done.wait(3600):
+                pass
+        else:
+            self._done.wait(timeout)
+        if not self._done.isSet():
+            if self.deadline is not None and timer() >= self.deadline:
+                self._finish(None, PatchTimeout())
+            else:
+                raise PatchTimeout()
+
+class _checker(object):
+    # a stats observer stopping the patch between hunks
+    def __init__(self, job):
+        self.job = job
+
+    def hunkparsed(self, h, seconds):
+        self.job.check()
+
+    def hunkapplied(self, h, stat):
+        self.job.check()
+
+def _applyjob(args):
+    # runs in a worker process, errors are sent back as results
+    the_patch, original = args
+    import hgpatcher
+    try:
+        return hgpatcher.apply_patch(the_patch, original), None
+    except Exception, err:
+        return None, err
+
+class patchexecutor(object):
+    """Apply patches with at most 'workers' of them running at once.
+
+    Patches wait in a queue for one of the 'workers' threads, which
+    bounds how many run concurrently; a timed out or cancelled patch
+    stops before its next hunk. With 'processes' set, patches run in a
+    multiprocessing.Pool of 'workers' processes instead, and such a
+    patch keeps its process busy until it ends, its result dropped.
+    """
+    def __init__(self, workers=4, processes=False):
+        self.workers = workers
+        self.processes = processes
+        self._pool = None
+        self._queue = None
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _startthreads(self):
+        self._queue = Queue.Queue()
+        for x in xrange(self.workers):
+            t = threading.Thread(target=self._worker)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def _worker(self):
+        import hgpatcher
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            if not job.start():
+                continue
+            try:
+                job.check()
+                result = hgpatcher.apply_patch(job.the_patch, job.original,
+                                               _checker(job))
+            except Exception, err:
+                job._finish(None, err)
+            else:
+                job._finish(result, None)
+
+    def submit(self, the_patch, original, timeout=None):
+        """Queue 'the_patch' for 'original' and return a pendingpatch.
+        'timeout' counts seconds from now, queueing included."""
+        job = pendingpatch(the_patch, original, timeout)
+        self._lock.acquire()
+        try:
+            if self.processes:
+                if self._pool is None:
+                    import multiprocessing
+                    self._pool = multiprocessing.Pool(self.workers)
+                if job.start():
+                    self._pool.apply_async(_applyjob, [(the_patch, original)],
+                        callback=lambda res: job._finish(*res))
+            else:
+                if self._queue is None:
+                    self._startthreads()
+                self._queue.put(job)
+        finally:
+            self._lock.release()
+        return job
+
+    def shutdown(self, wait=True):
+        self._lock.acquire()
+        try:
+            if self._queue is not None:
+                for t in self._threads:
+                    self._queue.put(None)
+            if self._pool is not None:
+                self._pool.close()
+        finally:
+            self._lock.release()
+        if wait:
+            for t in self._threads:
+                t.join()
+            if self._pool is not None:
+                self._pool.join()
+        self._threads = []
+        self._queue = None
+        self._pool = None
+
+class batchresult(object):
+    """Outcome of one (patch, original) pair of a batch.
+
+    'index' is the position of the pair in the batch. 'status' is 'ok',
+    'fuzz' (applied, with fuzz), 'rejected' (some hunks failed, their
+    numbers are in 'rejects') or 'error' (the exception class name is
+    in 'error' and its text in 'message'). 'output' is the patched text,
+    None unless the patch applied.
+    """
+    def __init__(self, index, status, output=None, rejects=(), error=None,
+                 message=None):
+        self.index = index
+        self.status = status
+        self.output = output
+        self.rejects = list(rejects)
+        self.error = error
+        self.message = message
+
+    def __repr__(self):
+        return '<batchresult %d %s>' % (self.index, self.status)
+
+def _batchitem(item):
+    # runs in a worker process, so nothing may escape
+    index, (the_patch, original) = item
+    ui = patch.UIDummy()
+    try:
+        gitpatches, files = patch.hunkcache.readpatch(ui, the_patch,
+                                                      textmode=True)
+        if len(files) > 1:
+            raise ValueError('Expected only one file!')
+        targetfile = StringIO(original)
+        current_file = patch.patchfile(ui, None, targetfile, False, '\n')
+        fuzz = False
+        if files:
+            for ret in current_file.applyhunks(files[0][2]):
+                if ret > 0:
+                    fuzz = True
+        if current_file.rej:
+            return batchresult(index, 'rejected',
+                               rejects=[h.number for h in current_file.rej])
+        current_file.write()
+        return batchresult(index, fuzz and 'fuzz' or 'ok',
+                           targetfile.getvalue())
+    except Exception, err:
+        return batchresult(index, 'error', error=err.__class__.__name__,
+                           message=str(err))
+
+def applybatch(pairs, workers=None, chunksize=64, ordered=True):
+    """Apply each (patch, original) pair of 'pairs' on a process pool.
+
+    Pairs are shipped to 'workers' processes 'chunksize' at a time.
+    Yields a batchresult per pair, in the order of 'pairs' or, if
+    'ordered' is False, as they complete. A failing pair only affects
+    its own result. With 'workers' set to 1, everything runs in this
+    process.
+    """
+    items = enumerate(pairs)
+    if workers == 1:
+        for item in items:
+            yield _batchitem(item)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    try:
+        if ordered:
+            results = pool.imap(_batchitem, items, chunksize)
+        else:
+            results = pool.imap_unordered(_batchitem, items, chunksize)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
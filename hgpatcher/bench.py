@@ -0,0 +1,230 @@
+# bench.py - benchmarks for patch parsing and application
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""Benchmark patch parsing and application on synthetic workloads.
+
+Run as "python -m hgpatcher.bench" to print a JSON report on stdout.
+Each workload runs in a fresh process so that its peak memory can be
+measured on its own.
+"""
+
+import json, platform, resource, sys
+import multiprocessing
+import optparse
+from timeit import default_timer as timer
+from StringIO import StringIO
+
+from hgpatcher import diffhelpers, patch
+
+KINDS = ('exact', 'offset', 'fuzz1', 'fuzz2', 'crlf', 'context',
+         'duplicates')
+
+# (lines, hunks, hunk size) grids
+GRID = [(l, h, s) for l in (1000, 10000, 100000)
+                  for h in (10, 100, 1000)
+                  for s in (1, 5)]
+QUICKGRID = [(l, h, 1) for l in (1000, 10000) for h in (10, 100)]
+
+CONTEXT = 3
+# lines inserted at the top of 'offset' and 'duplicates' targets
+SHIFT = 7
+_dups = ['\n', '}\n', '{\n', 'end\n']
+
+def feasible(lines, hunks, hunksize):
+    return hunks * (hunksize + 2 * CONTEXT + 1) <= lines
+
+def makeworkload(kind, lines, hunks, hunksize):
+    """Return a (patch, original, expected) tuple of strings.
+
+    The patch changes 'hunks' evenly spaced blocks of 'hunksize' lines,
+    with three lines of context. 'kind' is one of KINDS and selects the
+    patch format and how the original differs from what the patch
+    expects.
+    """
+    if kind == 'duplicates':
+        orig = [_dups[x % len(_dups)] for x in xrange(lines)]
+    else:
+        orig = ['line %d of the original text\n' % x for x in xrange(lines)]
+    step = lines // hunks
+    blocks = []
+    for k in xrange(hunks):
+        start = k * step + CONTEXT
+        for x in xrange(start, start + hunksize):
+            # changed lines are unique, even among duplicates
+            orig[x] = 'old line %d\n' % x
+        new = ['new line %d\n' % x for x in xrange(start, start + hunksize)]
+        blocks.append((start, new))
+
+    if kind == 'context':
+        text = contextdiff(orig, blocks, hunksize)
+    else:
+        text = unifieddiff(orig, blocks, hunksize)
+
+    target = list(orig)
+    if kind in ('fuzz1', 'fuzz2'):
+        fuzz = int(kind[-1])
+        for start, new in blocks:
+            for x in xrange(start - CONTEXT, start - CONTEXT + fuzz):
+                target[x] = 'fuzzed line %d\n' % x
+    expected = list(target)
+    for start, new in reversed(blocks):
+        expected[start:start + hunksize] = new
+    if kind in ('offset', 'duplicates'):
+        target[:0] = ['shifted\n'] * SHIFT
+        expected[:0] = ['shifted\n'] * SHIFT
+    target = ''.join(target)
+    if kind == 'crlf':
+        target = target.replace('\n', '\r\n')
+    return text, target, ''.join(expected)
+
+def unifieddiff(orig, blocks, hunksize):
+    out = ['--- a/file\n', '+++ b/file\n']
+    for start, new in blocks:
+        lo = start - CONTEXT
+        hi = start + hunksize + CONTEXT
+        n = hi - lo
+        out.append('@@ -%d,%d +%d,%d @@\n' % (lo + 1, n, lo + 1, n))
+        out.extend(' ' + l for l in orig[lo:start])
+        out.extend('-' + l for l in orig[start:start + hunksize])
+        out.extend('+' + l for l in new)
+        out.extend(' ' + l for l in orig[start + hunksize:hi])
+    return ''.join(out)
+
+def contextdiff(orig, blocks, hunksize):
+    out = ['*** a/file\n', '--- b/file\n']
+    for start, new in blocks:
+        lo = start - CONTEXT
+        hi = start + hunksize + CONTEXT
+        top = ['  ' + l for l in orig[lo:start]]
+        bottom = ['  ' + l for l in orig[start + hunksize:hi]]
+        out.append('***************\n')
+        out.append('*** %d,%d ****\n' % (lo + 1, hi))
+        out.extend(top)
+        out.extend('! ' + l for l in orig[start:start + hunksize])
+        out.extend(bottom)
+        out.append('--- %d,%d ----\n' % (lo + 1, hi))
+        out.extend(top)
+        out.extend('! ' + l for l in new)
+        out.extend(bottom)
+    return ''.join(out)
+
+def maxrss():
+    # peak resident set size of this process, in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def runworkload(args):
+    """Time one workload and return its result record"""
+    kind, lines, hunks, hunksize, repeat = args
+    text, original, expected = makeworkload(kind, lines, hunks, hunksize)
+    baserss = maxrss()
+    ui = patch.UIDummy()
+    parsetime = applytime = None
+    for x in xrange(repeat):
+        start = timer()
+        gitpatches, files = patch.readpatch(ui, StringIO(text),
+                                            textmode=True)
+        elapsed = timer() - start
+        if parsetime is None or elapsed < parsetime:
+            parsetime = elapsed
+
+        targetfile = StringIO(original)
+        start = timer()
+        patch.applyparsed(ui, gitpatches, files, targetfile, {})
+        elapsed = timer() - start
+        if applytime is None or elapsed < applytime:
+            applytime = elapsed
+        if targetfile.getvalue() != expected:
+            raise patch.PatchError('%s workload applied wrongly' % kind)
+
+    total = parsetime + applytime
+    return {
+        'kind': kind,
+        'lines': lines,
+        'hunks': hunks,
+        'hunksize': hunksize,
+        'patch_bytes': len(text),
+        'target_bytes': len(original),
+        'parse_seconds': parsetime,
+        'apply_seconds': applytime,
+        'lines_per_second': lines / total,
+        'bytes_per_second': (len(text) + len(original)) / total,
+        'parse_usec_per_hunk': parsetime / hunks * 1e6,
+        'apply_usec_per_hunk': applytime / hunks * 1e6,
+        'peak_rss_kb': maxrss() - baserss,
+    }
+
+def comparetests(blocks=2000, repeat=3):
+    """Time diffhelpers.testhunk() against testlines() on every blank
+    line of a file of 'blocks' brace blocks, as when a fuzzy hunk is
+    anchored on a blank line. Returns the best times as a dict."""
+    target = []
+    for x in xrange(blocks):
+        target.extend(['block %d\n' % x, '\n', '{\n', '}\n', '\n'])
+    old = ['\n', '{\n', '}\n', '\n', 'block %d\n' % (blocks // 2)]
+    cands = patch.lineindex(target).positions('\n')
+    def best(test, old):
+        result = None
+        for x in xrange(repeat):
+            start = timer()
+            for c in cands:
+                test(old, target, c)
+            elapsed = timer() - start
+            if result is None or elapsed < result:
+                result = elapsed
+        return result
+    return {
+        'candidates': len(cands),
+        'testhunk_seconds': best(diffhelpers.testhunk,
+                                 [' ' + l for l in old]),
+        'testlines_seconds': best(diffhelpers.testlines, old),
+    }
+
+def run(grid=GRID, kinds=KINDS, repeat=3):
+    """Run every feasible workload of the grid, each in a new process,
+    and return the report as a dict"""
+    jobs = [(kind, lines, hunks, hunksize, repeat)
+            for lines, hunks, hunksize in grid
+            if feasible(lines, hunks, hunksize)
+            for kind in kinds]
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        results = pool.map(runworkload, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--quick', action='store_true',
+                      help='run a small grid only')
+    parser.add_option('--kind', action='append', choices=KINDS,
+                      help='workload kind to run, may be repeated')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='runs per workload, the best one is kept')
+    parser.add_option('--compare-tests', action='store_true',
+                      help='only time testhunk() against testlines()')
+    parser.add_option('-o', '--output', help='write the report to a file')
+    opts, args = parser.parse_args(args)
+    if opts.compare_tests:
+        report = comparetests(repeat=opts.repeat)
+    else:
+        report = run(opts.quick and QUICKGRID or GRID, opts.kind or KINDS,
+                     opts.repeat)
+    fp = opts.output and open(opts.output, 'w') or sys.stdout
+    try:
+        json.dump(report, fp, indent=1, sort_keys=True)
+        fp.write('\n')
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+
+if __name__ == '__main__':
+    main()
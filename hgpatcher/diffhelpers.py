@@ -32,6 +32,41 @@ def addlines(fp, hunk, lena, lenb, a, b):
                 a.append(s)
     return 0
 
+def addrun(lines, pos, hunk, lena, lenb, a, b):
+    # like addlines, reading from the list 'lines' at 'pos' and
+    # returning the position after the hunk. Runs of lines are added
+    # whole unless they hold a no newline marker or an empty line.
+    marker = "\\ No newline at end of file\n"
+    while True:
+        num = max(lena - len(a), lenb - len(b))
+        if num == 0:
+            break
+        run = lines[pos:pos + num]
+        pos += num
+        if len(run) < num:
+            raise IndexError('hunk cut short')
+        if marker not in run and "\n" not in run:
+            hunk.extend(run)
+            a.extend([s for s in run if s[0] != "+"])
+            b.extend([s[1:] for s in run if s[0] != "-"])
+            continue
+        for s in run:
+            c = s[0]
+            if s == marker:
+                fix_newline(hunk, a, b)
+                continue
+            if c == "\n":
+                s = " \n"
+            hunk.append(s)
+            if c == "+":
+                b.append(s[1:])
+            elif c == "-":
+                a.append(s)
+            else:
+                b.append(s[1:])
+                a.append(s)
+    return pos
+
 def fix_newline(hunk, a, b):
     l = hunk[-1]
     c = l[0]
@@ -54,3 +89,13 @@ def testhunk(a, b, bstart):
         if a[i][1:] != b[i + bstart]:
             return -1
     return 0
+
+def testlines(a, b, bstart):
+    # like testhunk, but the lines of 'a' have no leading control char,
+    # so they can be compared as a single block
+    alen = len(a)
+    if bstart < 0 or alen > len(b) - bstart:
+        return -1
+    if b[bstart:bstart + alen] != a:
+        return -1
+    return 0
@@ -0,0 +1,393 @@
+# mdiff.py - compute differences between texts as patch hunks
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""Diff two texts into hunk objects that apply like parsed ones.
+
+Lines found once on each side are matched first, as in patience diff,
+which cuts large texts into many small ranges. What lies between them
+goes through Myers' O(ND) algorithm, in its linear space variant: the
+middle snake of each range splits it in two, after common leading and
+trailing lines are set aside. As in xdiff, lines missing from the other
+side are left out beforehand, and a search costing more than 256 edits
+settles for the furthest path found, so rewritten texts stay cheap.
+Hunks are built directly from the lines, no diff text is written or
+parsed; unidiff() renders them when text is needed.
+"""
+
+import bisect
+from itertools import izip
+import patch
+from patch import splitlines
+
+def _middlesnake(a, alo, ahi, b, blo, bhi, maxcost=256):
+    # return (x, y, u, v): a[x:u] == b[y:v] lies on an optimal path.
+    # Past 'maxcost' edits, as in xdiff, give up on the optimum and
+    # split at the forward path that went furthest, with u, v = x, y.
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    odd = delta & 1
+    maxd = (n + m + 1) // 2
+    off = min(maxd, maxcost + 1) + 1
+    vf = [0] * (2 * off + 1)
+    vb = [0] * (2 * off + 1)
+    for d in xrange(maxd + 1):
+        if d > maxcost:
+            best = -1
+            for k in xrange(-d + 1, d, 2):
+                x = min(vf[off + k], n)
+                y = x - k
+                if 0 <= y <= m and x + y > best:
+                    best = x + y
+                    bx, by = x, y
+            return alo + bx, blo + by, alo + bx, blo + by
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and vf[off + k - 1] < vf[off + k + 1]):
+                x = vf[off + k + 1]
+            else:
+                x = vf[off + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            vf[off + k] = x
+            if odd and -d < delta - k < d and x + vb[off + delta - k] >= n:
+                return alo + x0, blo + y0, alo + x, blo + y
+        for k in xrange(-d, d + 1, 2):
+            # backwards, x and y count from the ends
+            if k == -d or (k != d and vb[off + k - 1] < vb[off + k + 1]):
+                x = vb[off + k + 1]
+            else:
+                x = vb[off + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while (x < n and y < m and
+                   a[ahi - x - 1] == b[bhi - y - 1]):
+                x += 1
+                y += 1
+            vb[off + k] = x
+            if (not odd and -d <= delta - k <= d and
+                x + vf[off + delta - k] >= n):
+                return ahi - x, bhi - y, ahi - x0, bhi - y0
+    raise AssertionError('no middle snake')
+
+def _common(a, i, b, j, n, step=1):
+    # length of the common run of a[i:i+n] and b[j:j+n], or of the
+    # runs ending there if step is -1. Slices are compared rather than
+    # lines, in growing chunks, so that long runs are cheap.
+    k = 0
+    size = 1
+    while k < n:
+        size = min(size, n - k)
+        if step > 0:
+            same = a[i + k:i + k + size] == b[j + k:j + k + size]
+        else:
+            same = a[i - k - size:i - k] == b[j - k - size:j - k]
+        if same:
+            k += size
+            size *= 2
+        elif size == 1:
+            break
+        else:
+            size //= 2
+    return k
+
+def _unique(lines, lo, hi):
+    # {line: position} for the lines found once in lines[lo:hi]
+    part = lines[lo:hi]
+    last = dict(izip(part, xrange(lo, hi)))
+    if len(last) == len(part):
+        return last
+    first = dict(izip(reversed(part), xrange(hi - 1, lo - 1, -1)))
+    return dict(p for p in last.iteritems() if first[p[0]] == p[1])
+
+def _anchors(a, alo, ahi, b, blo, bhi):
+    # (i, j) pairs of lines found once in a[alo:ahi] and once in
+    # b[blo:bhi], the longest run of them ascending on both sides
+    ua = _unique(a, alo, ahi)
+    ub = _unique(b, blo, bhi)
+    pairs = [(i, ub[l]) for i, l in enumerate(a[alo:ahi], alo)
+             if l in ub and ua.get(l) == i]
+    js = [j for i, j in pairs]
+    if js == sorted(js):
+        # nothing moved
+        return pairs
+    # patience sorting: the top of each pile, and back pointers
+    tops = []
+    topidx = []
+    back = []
+    for k, j in enumerate(js):
+        p = bisect.bisect_left(tops, j)
+        if p == len(tops):
+            tops.append(j)
+            topidx.append(k)
+        else:
+            tops[p] = j
+            topidx[p] = k
+        back.append(p and topidx[p - 1] or -1)
+    res = []
+    k = topidx[-1]
+    while k >= 0:
+        res.append(pairs[k])
+        k = back[k]
+    res.reverse()
+    return res
+
+def matchingblocks(a, b):
+    """Return the (i, j, n) triples such that a[i:i+n] == b[j:j+n], in
+    ascending order, covering the lines left unchanged."""
+    # as in xdiff, lines missing from the other side cannot match and
+    # are left out, which makes rewritten texts cheap
+    common = set(a).intersection(b)
+    ia = [i for i, l in enumerate(a) if l in common]
+    ib = [j for j, l in enumerate(b) if l in common]
+    if len(ia) == len(a) and len(ib) == len(b):
+        return _blocks(a, b)
+    blocks = []
+    for i, j, n in _blocks([a[i] for i in ia], [b[j] for j in ib]):
+        if ia[i + n - 1] - ia[i] == n - 1 and ib[j + n - 1] - ib[j] == n - 1:
+            runs = [(ia[i], ib[j], n)]
+        else:
+            runs = [(ia[i + t], ib[j + t], 1) for t in xrange(n)]
+        for x, y, k in runs:
+            last = blocks and blocks[-1]
+            if last and last[0] + last[2] == x and last[1] + last[2] == y:
+                blocks[-1] = (last[0], last[1], last[2] + k)
+            else:
+                blocks.append((x, y, k))
+    return blocks
+
+def _blocks(a, b):
+    # the matching blocks of a and b, all lines of which may match
+    blocks = []
+    todo = [(0, len(a), 0, len(b))]
+    while todo:
+        alo, ahi, blo, bhi = todo.pop()
+        # common leading and trailing lines
+        x = _common(a, alo, b, blo, min(ahi - alo, bhi - blo))
+        if x:
+            blocks.append((alo, blo, x))
+            alo += x
+            blo += x
+        x = _common(a, ahi, b, bhi, min(ahi - alo, bhi - blo), -1)
+        if x:
+            blocks.append((ahi - x, bhi - x, x))
+            ahi -= x
+            bhi -= x
+        if alo == ahi or blo == bhi:
+            continue
+        if set(a[alo:ahi]).isdisjoint(b[blo:bhi]):
+            # nothing in common, the whole range is replaced
+            continue
+        anchors = _anchors(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            # lines unique on both sides are matched first, as in
+            # patience diff: cut the range before every run of them,
+            # each part then starts with lines in common
+            starts = [p for p, q in izip(anchors, [(-2, -2)] + anchors)
+                      if p[0] != q[0] + 1 or p[1] != q[1] + 1]
+            for i, j in starts:
+                todo.append((alo, i, blo, j))
+                alo, blo = i, j
+            todo.append((alo, ahi, blo, bhi))
+            continue
+        x, y, u, v = _middlesnake(a, alo, ahi, b, blo, bhi)
+        if u > x:
+            blocks.append((x, y, u - x))
+        todo.append((alo, x, blo, y))
+        todo.append((u, ahi, v, bhi))
+    blocks.sort()
+    # join adjacent blocks
+    merged = []
+    for i, j, n in blocks:
+        if merged and merged[-1][0] + merged[-1][2] == i and \
+           merged[-1][1] + merged[-1][2] == j:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + n)
+        else:
+            merged.append((i, j, n))
+    return merged
+
+def opcodes(blocks, lena, lenb):
+    """Turn matching blocks into (equal, i1, i2, j1, j2) tuples, where
+    a[i1:i2] is to be replaced by b[j1:j2] unless 'equal' is True."""
+    ops = []
+    i = j = 0
+    for bi, bj, n in blocks + [(lena, lenb, 0)]:
+        if bi > i or bj > j:
+            ops.append((False, i, bi, j, bj))
+        if n:
+            ops.append((True, bi, bi + n, bj, bj + n))
+        i, j = bi + n, bj + n
+    return ops
+
+def groupops(ops, context=3):
+    """Yield the lists of opcodes making up each hunk, with at most
+    'context' equal lines before and after every change."""
+    group = []
+    for op in ops:
+        equal, i1, i2, j1, j2 = op
+        if not equal:
+            group.append(op)
+            continue
+        if not group:
+            # leading context of the next hunk
+            n = min(i2 - i1, context)
+            group.append((True, i2 - n, i2, j2 - n, j2))
+        elif i2 - i1 > 2 * context:
+            n = min(i2 - i1, context)
+            if n:
+                group.append((True, i1, i1 + n, j1, j1 + n))
+            yield group
+            group = [(True, i2 - n, i2, j2 - n, j2)]
+        else:
+            group.append(op)
+    if group and not group[-1][0]:
+        yield group
+    elif len(group) > 1:
+        n = min(group[-1][2] - group[-1][1], context)
+        equal, i1, i2, j1, j2 = group[-1]
+        group[-1] = (True, i1, i1 + n, j1, j1 + n)
+        yield group
+
+def makehunk(number, a, b, ops, astart=0, bstart=0):
+    """Build a unified patch.hunk from a group of opcodes of the lines
+    'a' and 'b', which start at lines 'astart' and 'bstart' of their
+    files."""
+    lines = []
+    for equal, i1, i2, j1, j2 in ops:
+        if equal:
+            lines.extend(' ' + l for l in a[i1:i2])
+        else:
+            lines.extend('-' + l for l in a[i1:i2])
+            lines.extend('+' + l for l in b[j1:j2])
+    i1, j1 = ops[0][1], ops[0][3]
+    lena, lenb = ops[-1][2] - i1, ops[-1][4] - j1
+    i1 += astart
+    j1 += bstart
+    # an empty side starts at the line before it, as with diff -u
+    starta = lena and i1 + 1 or i1
+    startb = lenb and j1 + 1 or j1
+    desc = '@@ -%d,%d +%d,%d @@\n' % (starta, lena, startb, lenb)
+    h = patch.hunk(desc, number, None, False)
+    h.starta, h.lena, h.startb, h.lenb = starta, lena, startb, lenb
+    h.hunk.extend(lines)
+    h.a = [l for l in lines if l[0] != '+']
+    h.b = [l[1:] for l in lines if l[0] != '-']
+    return h
+
+def diff(a, b, context=3):
+    """Return the list of hunks turning the lines 'a' into the lines
+    'b', with 'context' unchanged lines around each change."""
+    ops = opcodes(matchingblocks(a, b), len(a), len(b))
+    hunks = []
+    for group in groupops(ops, context):
+        hunks.append(makehunk(len(hunks) + 1, a, b, group))
+    return hunks
+
+def diffparsed(a, b, afile='a', bfile='b', context=3):
+    """Like diff(), for the texts 'a' and 'b', returned as readpatch()
+    does, ready for applyparsed() and the like."""
+    hunks = diff(splitlines(a), splitlines(b), context)
+    if not hunks:
+        return (), ()
+    return (), ((afile, bfile, tuple(hunks)),)
+
+def compose(hunks1, hunks2):
+    """Return hunks doing what 'hunks1' then 'hunks2' do.
+
+    The hunks of each patch must be in order and not overlap, those of
+    'hunks2' being made against the output of 'hunks1'. Hunks touching
+    the same lines are merged; where they disagree on what these lines
+    are, patch.PatchConflict is raised. No original text is needed,
+    and hunks stay where the patches said: offsets and fuzz found when
+    applying them cannot be known here.
+    """
+    spans = []
+    for side, hunks in enumerate((hunks1, hunks2)):
+        for h in hunks:
+            if isinstance(h, patch.binhunk):
+                raise patch.PatchConflict('cannot compose binary hunk #%d'
+                                          % h.number)
+            if side:
+                start, length = h.oldstart(), h.lena
+            else:
+                start, length = h.newstart(), h.lenb
+            spans.append((start, start + length, side, h))
+    spans.sort(key=lambda x: (x[0], x[1], x[2]))
+
+    # group hunks touching the same lines of the intermediate text
+    clusters = []
+    for start, end, side, h in spans:
+        if clusters and start <= clusters[-1][1]:
+            c = clusters[-1]
+            c[1] = max(c[1], end)
+            c[2].append((start, end, side, h))
+        else:
+            clusters.append([start, end, [(start, end, side, h)]])
+
+    res = []
+    # how far the old and new files are from the intermediate one
+    delta1 = delta2 = 0
+    for bs, be, members in clusters:
+        # the intermediate lines, as both patches see them
+        mid = [None] * (be - bs)
+        for start, end, side, h in members:
+            if side:
+                lines = h.oldtext()
+            else:
+                lines = h.new()
+            for x, l in enumerate(lines, start - bs):
+                if mid[x] is None:
+                    mid[x] = l
+                elif mid[x] != l:
+                    raise patch.PatchConflict('cannot compose hunk #%d: '
+                                              'it does not match the '
+                                              'previous patch' % h.number)
+        old, new = [], []
+        for side, out in ((0, old), (1, new)):
+            pos = bs
+            for start, end, hside, h in members:
+                if hside != side:
+                    continue
+                if start < pos:
+                    raise patch.PatchConflict('hunk #%d overlaps the '
+                                              'previous one' % h.number)
+                out.extend(mid[pos - bs:start - bs])
+                if side:
+                    out.extend(h.new())
+                else:
+                    out.extend(h.oldtext())
+                pos = end
+            out.extend(mid[pos - bs:])
+        astart, cstart = bs - delta1, bs + delta2
+        for start, end, side, h in members:
+            if side:
+                delta2 += h.lenb - h.lena
+            else:
+                delta1 += h.lenb - h.lena
+        if old == new:
+            continue
+        ops = opcodes(matchingblocks(old, new), len(old), len(new))
+        res.append(makehunk(len(res) + 1, old, new, ops, astart, cstart))
+    return res
+
+def writepatch(hunks, afile='a', bfile='b'):
+    """Return 'hunks' as unified diff text."""
+    if not hunks:
+        return ''
+    out = ['--- %s\n' % afile, '+++ %s\n' % bfile]
+    for h in hunks:
+        out.append(h.desc)
+        for l in h.hunk[1:]:
+            out.append(l)
+            if not l.endswith('\n'):
+                out.append('\n\\ No newline at end of file\n')
+    return ''.join(out)
+
+def unidiff(a, b, afile='a', bfile='b', context=3):
+    """Return the unified diff of the texts 'a' and 'b'."""
+    return writepatch(diff(splitlines(a), splitlines(b), context),
+                      afile, bfile)
@@ -6,9 +6,14 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2, incorporated herein by reference.
 
-import diffhelpers
-import cStringIO, re
+import base85, diffhelpers
+from stats import hunkstat, patchstats
+import copy, cStringIO, re
 import zlib
+import array, bisect, hashlib, heapq, threading
+from collections import OrderedDict
+from StringIO import StringIO
+from timeit import default_timer as timer
 _ = lambda s: s
 
 gitre = re.compile('diff --git a/(.*) b/(.*)')
@@ -19,12 +24,24 @@ class PatchError(Exception):
 class NoHunks(PatchError):
     pass
 
+class PatchTimeout(PatchError):
+    pass
+
+class PatchCancelled(PatchError):
+    pass
+
+class PatchConflict(PatchError):
+    pass
+
+class TruncatedPatch(PatchError):
+    # the patch ends inside a hunk
+    pass
+
 # helper functions
 
 # public functions
 
 GP_PATCH  = 1 << 0  # we have to run patch
-GP_FILTER = 1 << 1  # there's some copy/rename operation
 GP_BINARY = 1 << 2  # there's a binary patch
 
 class patchmeta(object):
@@ -35,7 +52,8 @@ class patchmeta(object):
     origin file when 'op' is either COPY or RENAME, None otherwise. If
     file mode is changed, 'mode' is a tuple (islink, isexec) where
     'islink' is True if the file is a symlink and 'isexec' is True if
-    the file is executable. Otherwise, 'mode' is None.
+    the file is executable. Otherwise, 'mode' is None. 'lineno' is the
+    line of its "diff --git" header in the patch, counting from 1.
     """
     def __init__(self, path):
         self.path = path
@@ -50,85 +68,78 @@ class patchmeta(object):
         isexec = mode & 0100
         self.mode = (islink, isexec)
 
-def readgitpatch(lr):
-    """extract git-style metadata about patches from <patchname>"""
-
-    # Filter patch for git information
-    gp = None
-    gitpatches = []
-    # Can have a git patch with only metadata, causing patch to complain
-    dopatch = 0
-
-    lineno = 0
-    for line in lr:
-        lineno += 1
-        line = line.rstrip(' \r\n')
-        if line.startswith('diff --git'):
-            m = gitre.match(line)
-            if m:
-                if gp:
-                    gitpatches.append(gp)
-                dst = m.group(2)
-                gp = patchmeta(dst)
-                gp.lineno = lineno
-        elif gp:
-            if line.startswith('--- '):
-                if gp.op in ('COPY', 'RENAME'):
-                    dopatch |= GP_FILTER
-                gitpatches.append(gp)
-                gp = None
-                dopatch |= GP_PATCH
-                continue
-            if line.startswith('rename from '):
-                gp.op = 'RENAME'
-                gp.oldpath = line[12:]
-            elif line.startswith('rename to '):
-                gp.path = line[10:]
-            elif line.startswith('copy from '):
-                gp.op = 'COPY'
-                gp.oldpath = line[10:]
-            elif line.startswith('copy to '):
-                gp.path = line[8:]
-            elif line.startswith('deleted file'):
-                gp.op = 'DELETE'
-                # is the deleted file a symlink?
-                gp.setmode(int(line[-6:], 8))
-            elif line.startswith('new file mode '):
-                gp.op = 'ADD'
-                gp.setmode(int(line[-6:], 8))
-            elif line.startswith('new mode '):
-                gp.setmode(int(line[-6:], 8))
-            elif line.startswith('GIT binary patch'):
-                dopatch |= GP_BINARY
-                gp.binary = True
-    if gp:
-        gitpatches.append(gp)
-
-    if not gitpatches:
-        dopatch = GP_PATCH
-
-    return (dopatch, gitpatches)
+def githeader(gp, line):
+    """Update 'gp' with the git extended header 'line', stripped of its
+    line ending. Returns False if 'line' is not such a header."""
+    if line.startswith('rename from '):
+        gp.op = 'RENAME'
+        gp.oldpath = line[12:]
+    elif line.startswith('rename to '):
+        gp.path = line[10:]
+    elif line.startswith('copy from '):
+        gp.op = 'COPY'
+        gp.oldpath = line[10:]
+    elif line.startswith('copy to '):
+        gp.path = line[8:]
+    elif line.startswith('deleted file'):
+        gp.op = 'DELETE'
+        # is the deleted file a symlink?
+        gp.setmode(int(line[-6:], 8))
+    elif line.startswith('new file mode '):
+        gp.op = 'ADD'
+        gp.setmode(int(line[-6:], 8))
+    elif line.startswith('new mode '):
+        gp.setmode(int(line[-6:], 8))
+    elif not line.startswith(('old mode ', 'index ', 'similarity index ',
+                              'dissimilarity index ')):
+        return False
+    return True
+
+def splitlines(data):
+    # like readlines(), lines only end at '\n'
+    if isinstance(data, str):
+        return cStringIO.StringIO(data).readlines()
+    lines = [l + '\n' for l in data.split('\n')]
+    if lines[-1] == '\n':
+        lines.pop()
+    else:
+        lines[-1] = lines[-1][:-1]
+    return lines
+
+def eolinfo(data):
+    """Return the line ending most used in 'data' and, if it mixes
+    '\n' and '\r\n', a bytearray flagging the lines ending with
+    '\r\n'."""
+    crlf = data.count('\r\n')
+    lf = data.count('\n') - crlf
+    if not crlf:
+        return '\n', None
+    if not lf:
+        return '\r\n', None
+    flags = bytearray(l.endswith('\r\n') for l in splitlines(data))
+    return crlf > lf and '\r\n' or '\n', flags
 
 class linereader(object):
-    # simple class to allow pushing lines back into the input stream
+    # the lines of fp, read and split at once, then walked with a
+    # cursor; pushing back the lines just read moves the cursor back
     def __init__(self, fp, textmode=False):
-        self.fp = fp
-        self.buf = []
+        data = fp.read()
+        if textmode and '\r\n' in data:
+            data = data.replace('\r\n', '\n')
+        self.lines = splitlines(data)
+        self.pos = 0
         self.textmode = textmode
 
     def push(self, line):
         if line is not None:
-            self.buf.append(line)
+            self.pos -= 1
 
     def readline(self):
-        if self.buf:
-            l = self.buf[0]
-            del self.buf[0]
-            return l
-        l = self.fp.readline()
-        if self.textmode and l.endswith('\r\n'):
-            l = l[:-2] + '\n'
-        return l
+        pos = self.pos
+        self.pos = pos + 1
+        if pos < len(self.lines):
+            return self.lines[pos]
+        return ''
 
     def __iter__(self):
         while 1:
@@ -141,17 +152,252 @@ class linereader(object):
 unidesc = re.compile('@@ -(\d+)(,(\d+))? \+(\d+)(,(\d+))? @@')
 contextdesc = re.compile('(---|\*\*\*) (\d+)(,(\d+))? (---|\*\*\*)')
 
+class lineindex(object):
+    """Line positions of a file being patched.
+
+    The {line: [positions]} hash is built once, over the original lines.
+    Edits are not applied to it: replace() only records them in a list
+    of [ostart, oend, cstart, lines] entries, sorted and merged so that
+    they never touch, which replace lines ostart to oend of the original
+    with 'lines', now found at cstart. Positions in the hash are shifted
+    by the edits preceding them when they are looked up.
+    """
+    def __init__(self, lines):
+        self.orig = lines
+        self.hash = None
+        self.edits = []
+        # {line: {id(edit): edit}} for lines added by edits
+        self.added = {}
+        # edit starts, in original and current coordinates, for bisect
+        self.ostarts = []
+        self.cstarts = []
+
+    def build(self):
+        if self.hash is not None:
+            return
+        self.hash = {}
+        for x, s in enumerate(self.orig):
+            self.hash.setdefault(s, []).append(x)
+
+    def _delta(self, i):
+        # current minus original position, past the first i edits
+        if i <= 0:
+            return 0
+        e = self.edits[i - 1]
+        return e[2] + len(e[3]) - e[1]
+
+    def __len__(self):
+        return len(self.orig) + self._delta(len(self.edits))
+
+    def current(self, x):
+        """current position of original line x, None if replaced"""
+        i = bisect.bisect_right(self.ostarts, x)
+        if i and x < self.edits[i - 1][1]:
+            return None
+        return x + self._delta(i)
+
+    def original(self, c):
+        """original position splitting lines before and after current
+        position c"""
+        i = bisect.bisect_right(self.cstarts, c)
+        if i:
+            ostart, oend, cstart, lines = self.edits[i - 1]
+            if c < cstart + len(lines):
+                return ostart
+        return c - self._delta(i)
+
+    def _added(self, l):
+        # current positions of line l in edited ranges, ascending
+        res = []
+        for ostart, oend, cstart, lines in self.added.get(l, {}).itervalues():
+            for x, s in enumerate(lines):
+                if s == l:
+                    res.append(cstart + x)
+        res.sort()
+        return res
+
+    def count(self, l):
+        """cheap estimate of the occurrences of line l, 0 only if
+        there are none"""
+        self.build()
+        return len(self.hash.get(l, ())) + len(self.added.get(l, ()))
+
+    def positions(self, l):
+        """current positions of line l, in ascending order"""
+        self.build()
+        res = []
+        for x in self.hash.get(l, ()):
+            c = self.current(x)
+            if c is not None:
+                res.append(c)
+        return list(heapq.merge(res, self._added(l)))
+
+    def nearest(self, l, linenum):
+        """yield current positions of line l, nearest to linenum first
+
+        Positions are walked outward from linenum, so the first ones
+        come without looking at the rest.
+        """
+        self.build()
+        xs = self.hash.get(l, ())
+        added = self._added(l)
+        split = bisect.bisect_left(xs, self.original(linenum))
+        asplit = bisect.bisect_left(added, linenum)
+        current = self.current
+
+        def up():
+            for k in xrange(split, len(xs)):
+                c = current(xs[k])
+                if c is not None:
+                    yield c
+
+        def down():
+            # negated, so that heapq.merge sees them ascending
+            for k in xrange(split - 1, -1, -1):
+                c = current(xs[k])
+                if c is not None:
+                    yield -c
+
+        hi = heapq.merge(up(), iter(added[asplit:]))
+        lo = heapq.merge(down(), (-c for c in reversed(added[:asplit])))
+        right = next(hi, None)
+        left = next(lo, None)
+        while left is not None or right is not None:
+            # on ties, the earlier line wins
+            if right is None or (left is not None and
+                                 linenum + left <= right - linenum):
+                yield -left
+                left = next(lo, None)
+            else:
+                yield right
+                right = next(hi, None)
+
+    def getlines(self, start, end):
+        """current lines from start to end"""
+        edits = self.edits
+        res = []
+        i = max(bisect.bisect_right(self.cstarts, start) - 1, 0)
+        pos = start
+        while pos < end:
+            if i < len(edits) and pos >= edits[i][2]:
+                cstart, lines = edits[i][2:]
+                if pos < cstart + len(lines):
+                    stop = min(end, cstart + len(lines))
+                    res.extend(lines[pos - cstart:stop - cstart])
+                    pos = stop
+                i += 1
+                continue
+            if i < len(edits):
+                stop = min(end, edits[i][2])
+            else:
+                stop = end
+            delta = self._delta(i)
+            res.extend(self.orig[pos - delta:stop - delta])
+            pos = stop
+        return res
+
+    def replace(self, start, length, lines):
+        """record that current lines start to start+length became lines"""
+        end = start + length
+        edits = self.edits
+        # merge with every edit touching the replaced range
+        i = bisect.bisect_right(self.cstarts, end)
+        j = i
+        while j and edits[j - 1][2] + len(edits[j - 1][3]) >= start:
+            j -= 1
+        mstart, mend = start, end
+        if j < i:
+            mstart = min(start, edits[j][2])
+            mend = max(end, edits[i - 1][2] + len(edits[i - 1][3]))
+        merged = (self.getlines(mstart, start) + list(lines) +
+                  self.getlines(end, mend))
+        ostart = mstart - self._delta(j)
+        oend = mend - self._delta(i)
+
+        shift = len(lines) - length
+        for e in edits[i:]:
+            e[2] += shift
+        if ostart == oend and not merged:
+            new = []
+        else:
+            new = [[ostart, oend, mstart, merged]]
+        for e in edits[j:i]:
+            for l in set(e[3]):
+                del self.added[l][id(e)]
+                if not self.added[l]:
+                    del self.added[l]
+        for e in new:
+            for l in set(e[3]):
+                self.added.setdefault(l, {})[id(e)] = e
+        edits[j:i] = new
+        self.ostarts[j:i] = [e[0] for e in new]
+        self.cstarts[j:i] = [e[2] for e in new]
+        for k in xrange(j + len(new), len(edits)):
+            self.cstarts[k] = edits[k][2]
+
+def locatelines(lines, blocks):
+    """Find where each list of lines in 'blocks' occurs in 'lines'.
+
+    Rabin-Karp in a single scan: the rolling hash of every window of
+    'lines' as wide as the shortest block is looked up among the hashes
+    of the first lines of the blocks, and hits are checked against the
+    whole block. Returns, for every block, the ascending positions
+    where it starts.
+    """
+    base = 1000003
+    mod = (1 << 61) - 1
+    found = [[] for block in blocks]
+    widths = [len(block) for block in blocks if block]
+    if not widths or min(widths) > len(lines):
+        return found
+    m = min(widths)
+    wanted = {}
+    for k, block in enumerate(blocks):
+        if not block:
+            continue
+        h = 0
+        for l in block[:m]:
+            h = (h * base + hash(l)) % mod
+        wanted.setdefault(h, []).append(k)
+    hashes = [hash(l) % mod for l in lines]
+    top = pow(base, m - 1, mod)
+    h = 0
+    for x in xrange(m):
+        h = (h * base + hashes[x]) % mod
+    testlines = diffhelpers.testlines
+    for x in xrange(len(hashes) - m + 1):
+        if x:
+            h = ((h - hashes[x - 1] * top) * base + hashes[x + m - 1]) % mod
+        ks = wanted.get(h)
+        if ks is not None:
+            for k in ks:
+                if testlines(blocks[k], lines, x) == 0:
+                    found[k].append(x)
+    return found
+
 class patchfile(object):
     def __init__(self, ui, fname, targetfile, missing=False, eol=None):
         self.fname = fname
         self.eol = eol
         self.targetfile = targetfile
         self.ui = ui
-        self.lines = list(linereader(targetfile, self.eol is not None))
         if missing is not False:
             raise NotImplementedError
 
-        self.hash = {}
+        # line endings are normalized in one go, and only put back
+        # when the file is written
+        data = targetfile.read()
+        # lines ending with '\r\n' in files mixing endings, see eolinfo()
+        self.crlf = None
+        if eol == 'keep':
+            self.eol, self.crlf = eolinfo(data)
+        if self.eol is not None and '\r\n' in data:
+            data = data.replace('\r\n', '\n')
+        self.lines = splitlines(data)
+
+        # self.lines is left as read, hunks are recorded in the index
+        # and only applied when the file is written
+        self.index = lineindex(self.lines)
         self.dirty = 0
         self.offset = 0
         self.skew = 0
@@ -160,25 +406,57 @@ class patchfile(object):
         self.printfile(False)
         self.hunks = 0
         self.missing = False
+        self.removed = False
+        # about the last hunk applied, for ui.stats
+        self.fastpath = False
+        self.tried = 0
+        self.hashtime = 0.0
+        self.position = None
+        # {id(hunk): original positions}, see locate()
+        self.located = {}
+
+    def joinlines(self, lines):
+        data = ''.join(lines)
+        if self.eol and self.eol != '\n':
+            data = data.replace('\n', self.eol)
+        return data
+
+    def keepeols(self):
+        # the patched text of a file mixing line endings: lines left
+        # from the original get their own back, the others the one
+        # most used in the file
+        out = []
+        pos = 0
+        for ostart, oend, cstart, lines in self.index.edits + [
+                [len(self.lines), None, None, ()]]:
+            for x in xrange(pos, ostart):
+                l = self.lines[x]
+                if self.crlf[x]:
+                    l = l[:-1] + '\r\n'
+                out.append(l)
+            out.append(self.joinlines(lines))
+            pos = oend
+        return ''.join(out)
 
     def writelines(self, fname, lines):
-        fp = cStringIO.StringIO()
-        try:
-            if self.eol and self.eol != '\n':
-                for l in lines:
-                    if l and l[-1] == '\n':
-                        l = l[:-1] + self.eol
-                    fp.write(l)
-            else:
-                fp.writelines(lines)
-            self.targetfile.seek(0)
-            self.targetfile.truncate()
-            self.targetfile.write(fp.getvalue())
-        finally:
-            fp.close()
+        self.writedata(self.joinlines(lines))
+
+    def writedata(self, data):
+        self.targetfile.seek(0)
+        self.targetfile.truncate()
+        self.targetfile.write(data)
+
+    def getvalue(self):
+        """the patched text so far"""
+        if self.crlf is not None and self.eol is not None:
+            return self.keepeols()
+        return self.joinlines(self.index.getlines(0, len(self.index)))
 
     def unlink(self, fname):
-        raise NotImplementedError
+        # a text patched on its own ends up empty, applyfile() drops it
+        self.replacelines(0, len(self.index), [])
+        self.dirty = 1
+        self.removed = True
 
     def printfile(self, warn):
         if self.fileprinted:
@@ -193,37 +471,114 @@ class patchfile(object):
 
 
     def findlines(self, l, linenum):
-        # looks through the hash and finds candidate lines.  The
-        # result is a list of line numbers sorted based on distance
+        # looks through the index and finds candidate lines.  The
+        # result is an iterator over line numbers, ordered by distance
         # from linenum
-
-        cand = self.hash.get(l, [])
-        if len(cand) > 1:
-            # resort our list of potentials forward then back.
-            cand.sort(key=lambda x: abs(x - linenum))
-        return cand
+        return self.index.nearest(l, linenum)
 
     def hashlines(self):
-        self.hash = {}
-        for x, s in enumerate(self.lines):
-            self.hash.setdefault(s, []).append(x)
+        # index the lines for the offset search, on first use
+        if self.index.hash is None:
+            start = timer()
+            self.index.build()
+            self.hashtime += timer() - start
+
+    def locate(self, hunks):
+        """Find the old lines of all 'hunks' in the file with a single
+        rolling hash scan, see locatelines(). The offset search tries
+        these positions before looking the hunks up in the index."""
+        hunks = [h for h in hunks if not isinstance(h, binhunk) and h.lena]
+        found = locatelines(self.lines, [h.oldtext() for h in hunks])
+        self.located = dict((id(h), p) for h, p in zip(hunks, found))
+
+    def candidates(self, h, old, search_start, fuzzlen):
+        # possible starts of 'old', nearest to search_start first
+        if not old:
+            yield search_start
+            return
+        located = self.located.get(id(h))
+        if not fuzzlen and located is not None:
+            cands = [c for c in map(self.index.current, located)
+                     if c is not None]
+            cands.sort(key=lambda c: (abs(c - search_start), c))
+            for c in cands:
+                yield c
+            # lines added by earlier hunks were not scanned, go on
+        self.hashlines()
+        # anchor on the rarest line of the hunk, not on the first one,
+        # which is often blank or a lone brace
+        anchor = min(xrange(len(old)),
+                     key=lambda k: self.index.count(old[k]))
+        for l in self.findlines(old[anchor], search_start + anchor):
+            yield l - anchor
+
+    def replacelines(self, start, length, lines):
+        if self.crlf is not None:
+            # leave context lines out of the edit, so that they stay
+            # original lines and keep their ending
+            current = self.index.getlines(start, start + length)
+            n = min(length, len(lines))
+            top = 0
+            while top < n and current[top] == lines[top]:
+                top += 1
+            bot = 0
+            while bot < n - top and current[-bot - 1] == lines[-bot - 1]:
+                bot += 1
+            start += top
+            length -= top + bot
+            lines = lines[top:len(lines) - bot]
+        self.index.replace(start, length, lines)
+
+    def testlines(self, old, start):
+        if start < 0:
+            return -1
+        current = self.index.getlines(start, start + len(old))
+        return diffhelpers.testlines(old, current, 0)
 
     def write_rej(self):
+        # there is no reject file to write, fail instead
         if self.rej:
-            raise NotImplementedError
+            raise PatchError(_("%d out of %d hunks FAILED") %
+                             (len(self.rej), self.hunks))
 
     def write(self, dest=None):
         if not self.dirty:
             return
         if dest is not None:
             raise NotImplementedError
-        self.writelines(self.fname, self.lines)
+        if self.crlf is not None and self.eol is not None:
+            self.writedata(self.keepeols())
+        else:
+            self.writelines(self.fname,
+                            self.index.getlines(0, len(self.index)))
 
     def close(self):
         self.write()
         self.write_rej()
 
     def apply(self, h):
+        stats = self.ui.stats
+        if stats is None:
+            return self._apply(h)
+        self.fastpath = False
+        self.tried = 0
+        self.hashtime = 0.0
+        self.position = self.orig_start = None
+        start = timer()
+        ret = self._apply(h)
+        elapsed = timer() - start
+        offset = None
+        if ret >= 0 and self.position is not None:
+            offset = self.position - self.orig_start
+        position = self.position
+        if position is not None:
+            position += 1
+        stats.hunkapplied(h, hunkstat(h.number, self.fastpath, self.tried, ret,
+                                      position, offset, elapsed,
+                                      self.hashtime))
+        return ret
+
+    def _apply(self, h):
         if not h.complete():
             raise PatchError(_("bad hunk #%d %s (%d %d %d %d)") %
                             (h.number, h.desc, len(h.a), h.lena, len(h.b),
@@ -235,71 +590,314 @@ class patchfile(object):
             self.rej.append(h)
             return -1
 
-        if h.createfile():
-            raise NotImplementedError
+        if isinstance(h, binhunk):
+            if h.rmfile():
+                self.unlink(self.fname)
+            else:
+                # the target is read again, without line ending
+                # conversions, and written as is
+                self.targetfile.seek(0)
+                data = self.targetfile.read()
+                self.replacelines(0, len(self.index), [h.apply(data)])
+                self.eol = None
+                self.dirty = 1
+            self.position = self.orig_start = 0
+            return 0
+
+        if h.createfile() and len(self.index):
+            self.ui.warn(_("file %s already exists\n") % self.fname)
+            self.rej.append(h)
+            return -1
 
         # fast case first, no offsets, no fuzz
-        old = h.old()
+        old = h.oldtext()
         # patch starts counting at 1 unless we are adding the file
         if h.starta == 0:
             start = 0
         else:
-            start = h.starta + self.offset - 1
-        orig_start = start
+            start = h.oldstart() + self.offset
+        orig_start = self.orig_start = start
         # if there's skew we want to emit the "(offset %d lines)" even
         # when the hunk cleanly applies at start + skew, so skip the
         # fast case code
-        if self.skew == 0 and diffhelpers.testhunk(old, self.lines, start) == 0:
+        if self.skew == 0 and self.testlines(old, start) == 0:
+            self.fastpath = True
+            self.position = start
             if h.rmfile():
                 self.unlink(self.fname)
             else:
-                self.lines[start : start + h.lena] = h.new()
+                self.replacelines(start, h.lena, h.new())
                 self.offset += h.lenb - h.lena
                 self.dirty = 1
             return 0
 
         # ok, we couldn't match the hunk.  Lets look for offsets and fuzz it
-        self.hashlines()
-        if h.hunk[-1][0] != ' ':
+        if h.atbottom():
             # if the hunk tried to put something at the bottom of the file
             # override the start line and use eof here
-            search_start = len(self.lines)
+            search_start = len(self.index)
         else:
             search_start = orig_start + self.skew
 
+        found = self.findhunk(h, search_start)
+        if found is not None:
+            l, fuzzlen, toponly = found
+            old = h.oldtext(fuzzlen, toponly)
+            self.position = l
+            newlines = h.new(fuzzlen, toponly)
+            self.replacelines(l, len(old), newlines)
+            self.offset += len(newlines) - len(old)
+            self.skew = l - orig_start
+            self.dirty = 1
+            self.succeeded(h, l, orig_start, fuzzlen)
+            return fuzzlen
+        self.printfile(True)
+        self.ui.warn(_("Hunk #%d FAILED at %d\n") % (h.number, orig_start))
+        self.rej.append(h)
+        return -1
+
+    def findhunk(self, h, search_start):
+        # look for the old lines of h, with growing fuzz, and return
+        # (position, fuzz, toponly) or None
         for fuzzlen in xrange(3):
             for toponly in [ True, False ]:
-                old = h.old(fuzzlen, toponly)
+                old = h.oldtext(fuzzlen, toponly)
 
-                cand = self.findlines(old[0][1:], search_start)
+                cand = self.candidates(h, old, search_start, fuzzlen)
                 for l in cand:
-                    if diffhelpers.testhunk(old, self.lines, l) == 0:
-                        newlines = h.new(fuzzlen, toponly)
-                        self.lines[l : l + len(old)] = newlines
-                        self.offset += len(newlines) - len(old)
-                        self.skew = l - orig_start
-                        self.dirty = 1
-                        if fuzzlen:
-                            fuzzstr = "with fuzz %d " % fuzzlen
-                            f = self.ui.warn
-                            self.printfile(True)
-                        else:
-                            fuzzstr = ""
-                            f = self.ui.note
-                        offset = l - orig_start - fuzzlen
-                        if offset == 1:
-                            msg = _("Hunk #%d succeeded at %d %s"
-                                    "(offset %d line).\n")
-                        else:
-                            msg = _("Hunk #%d succeeded at %d %s"
-                                    "(offset %d lines).\n")
-                        f(msg % (h.number, l+1, fuzzstr, offset))
-                        return fuzzlen
-        self.printfile(True)
+                    self.tried += 1
+                    if self.testlines(old, l) == 0:
+                        return l, fuzzlen, toponly
+        return None
+
+    def succeeded(self, h, l, orig_start, fuzzlen):
+        if fuzzlen:
+            fuzzstr = "with fuzz %d " % fuzzlen
+            f = self.ui.warn
+            self.printfile(True)
+        else:
+            fuzzstr = ""
+            f = self.ui.note
+        offset = l - orig_start - fuzzlen
+        if offset == 1:
+            msg = _("Hunk #%d succeeded at %d %s"
+                    "(offset %d line).\n")
+        else:
+            msg = _("Hunk #%d succeeded at %d %s"
+                    "(offset %d lines).\n")
+        f(msg % (h.number, l+1, fuzzstr, offset))
+
+    def applyhunks(self, hunks, plan=None):
+        """Apply 'hunks' one after the other if hunksordered() says
+        they can be, through applyplanned() otherwise; 'plan' forces
+        either way. Returns the apply() results, in the order given."""
+        if plan is None:
+            plan = not hunksordered(hunks)
+        if plan:
+            return self.applyplanned(hunks)
+        return [self.apply(h) for h in hunks]
+
+    def applyplanned(self, hunks):
+        """Apply text 'hunks' given in any order.
+
+        Each hunk is located in the original lines on its own, starting
+        from the position it states. They are then sorted by position
+        and applied in a single pass, so offsets are known exactly;
+        hunks overlapping one found before them are rejected. Returns
+        the apply() result of every hunk, in the order given.
+        """
+        stats = self.ui.stats
+        located = []
+        for k, h in enumerate(hunks):
+            if not h.complete():
+                raise PatchError(_("bad hunk #%d %s (%d %d %d %d)") %
+                                 (h.number, h.desc, len(h.a), h.lena,
+                                  len(h.b), h.lenb))
+            self.hunks += 1
+            start = timer()
+            self.tried = 0
+            self.hashtime = 0.0
+            orig_start = h.oldstart()
+            fastpath = self.testlines(h.oldtext(), orig_start) == 0
+            if fastpath:
+                found = orig_start, 0, False
+            else:
+                if h.atbottom():
+                    search_start = len(self.index)
+                else:
+                    search_start = orig_start
+                found = self.findhunk(h, search_start)
+            located.append([h, k, orig_start, found, fastpath, self.tried,
+                            self.hashtime, timer() - start])
+
+        plan = sorted([e for e in located if e[3] is not None],
+                      key=lambda e: (e[3][0], e[1]))
+        end = 0
+        for e in plan:
+            h, found = e[0], e[3]
+            l, fuzzlen, toponly = found
+            if l < end:
+                self.ui.warn(_("Hunk #%d overlaps an earlier hunk\n")
+                             % h.number)
+                e[3] = None
+            else:
+                end = l + len(h.oldtext(fuzzlen, toponly))
+
+        delta = 0
+        results = [None] * len(hunks)
+        for e in plan:
+            h, k, orig_start, found = e[:4]
+            if found is None:
+                continue
+            l, fuzzlen, toponly = found
+            old = h.oldtext(fuzzlen, toponly)
+            newlines = h.new(fuzzlen, toponly)
+            self.replacelines(l + delta, len(old), newlines)
+            delta += len(newlines) - len(old)
+            self.dirty = 1
+            self.succeeded(h, l, orig_start, fuzzlen)
+            results[k] = fuzzlen
+        self.offset = delta
+
+        for h, k, orig_start, found, fastpath, tried, hashtime, elapsed \
+                in located:
+            if found is None:
+                self.printfile(True)
+                self.ui.warn(_("Hunk #%d FAILED at %d\n")
+                             % (h.number, orig_start))
+                self.rej.append(h)
+                results[k] = -1
+            if stats is not None:
+                position = offset = None
+                if found is not None:
+                    position = found[0] + 1
+                    offset = found[0] - orig_start
+                stats.hunkapplied(h, hunkstat(h.number, fastpath, tried,
+                                              results[k], position, offset,
+                                              elapsed, hashtime))
+        return results
+
+class bufferfile(object):
+    """Patch a bytes-like buffer (str, mmap or memoryview) in place.
+
+    The buffer is never split into lines: only an array of line start
+    offsets is built, hunks are located with substring searches over
+    the buffer and write() copies unchanged spans straight from it.
+    Hunks are matched against the original content only, so a hunk
+    cannot apply over lines added by an earlier one, and line endings
+    are compared as they are.
+    """
+    def __init__(self, ui, buf):
+        if isinstance(buf, memoryview):
+            # memoryviews cannot be searched, copy once
+            buf = buf.tobytes()
+        self.ui = ui
+        self.buf = buf
+        # line x spans starts[x]:starts[x + 1]
+        self.starts = starts = array.array('l', [0])
+        x = buf.find('\n')
+        while x != -1:
+            starts.append(x + 1)
+            x = buf.find('\n', x + 1)
+        if starts[-1] != len(buf):
+            starts.append(len(buf))
+        self.edits = []
+        # lines before minline have been patched already
+        self.minline = 0
+        self.skew = 0
+        self.rej = []
+        self.hunks = 0
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def lineat(self, offset):
+        """line starting at offset, None if offset is inside a line"""
+        x = bisect.bisect_left(self.starts, offset)
+        if x < len(self.starts) and self.starts[x] == offset:
+            return x
+        return None
+
+    def findblock(self, block, linenum):
+        """find the line where the text 'block' starts, nearest to
+        linenum and made of whole lines, or None"""
+        buf = self.buf
+        if not block:
+            if self.minline <= linenum <= len(self):
+                return linenum
+            return None
+        lo = self.starts[self.minline]
+        mid = self.starts[max(min(linenum, len(self)), self.minline)]
+        fwd = buf.find(block, mid)
+        back = buf.rfind(block, lo, mid + len(block) - 1)
+        while fwd != -1 or back != -1:
+            # on ties, the earlier line wins
+            if fwd == -1 or (back != -1 and mid - back <= fwd - mid):
+                x, back = back, buf.rfind(block, lo, back + len(block) - 1)
+            else:
+                x, fwd = fwd, buf.find(block, fwd + 1)
+            l = self.lineat(x)
+            if l is not None and self.lineat(x + len(block)) is not None:
+                return l
+        return None
+
+    def apply(self, h):
+        if not h.complete():
+            raise PatchError(_("bad hunk #%d %s (%d %d %d %d)") %
+                            (h.number, h.desc, len(h.a), h.lena, len(h.b),
+                            h.lenb))
+
+        self.hunks += 1
+        if isinstance(h, binhunk):
+            if self.edits:
+                raise PatchError(_("binary hunk #%d follows text hunks") %
+                                 h.number)
+            self.edits.append((0, len(self), [h.apply(self.buf)]))
+            self.minline = len(self)
+            return 0
+
+        orig_start = h.oldstart()
+        # fast case first, as in patchfile: no offset, no fuzz
+        if self.skew == 0 and orig_start >= self.minline:
+            old = h.oldtext()
+            end = orig_start + len(old)
+            if (end <= len(self) and ''.join(old) ==
+                self.buf[self.starts[orig_start]:self.starts[end]]):
+                self.edits.append((orig_start, len(old), h.new()))
+                self.minline = end
+                return 0
+        if h.atbottom():
+            # the hunk puts something at the bottom of the file
+            search_start = len(self)
+        else:
+            search_start = orig_start + self.skew
+
+        for fuzzlen in xrange(3):
+            for toponly in [ True, False ]:
+                old = h.oldtext(fuzzlen, toponly)
+                l = self.findblock(''.join(old), search_start)
+                if l is None:
+                    continue
+                self.edits.append((l, len(old), h.new(fuzzlen, toponly)))
+                self.minline = l + len(old)
+                self.skew = l - orig_start
+                if fuzzlen:
+                    self.ui.warn(_("Hunk #%d succeeded at %d with fuzz %d\n")
+                                 % (h.number, l + 1, fuzzlen))
+                return fuzzlen
         self.ui.warn(_("Hunk #%d FAILED at %d\n") % (h.number, orig_start))
         self.rej.append(h)
         return -1
 
+    def write(self, fp):
+        """write the patched buffer to the file object fp"""
+        pos = 0
+        for l, length, lines in self.edits:
+            fp.write(self.buf[pos:self.starts[l]])
+            fp.write(''.join(lines))
+            pos = self.starts[l + length]
+        fp.write(self.buf[pos:])
+
 class hunk(object):
     def __init__(self, desc, num, lr, context, create=False, remove=False):
         self.number = num
@@ -307,9 +905,13 @@ class hunk(object):
         self.hunk = [ desc ]
         self.a = []
         self.b = []
+        self.atext = None
         self.starta = self.lena = None
         self.startb = self.lenb = None
-        if context:
+        # without a reader, the caller fills in the hunk (see mdiff)
+        if lr is None:
+            pass
+        elif context:
             self.read_context_hunk(lr)
         else:
             self.read_unified_hunk(lr)
@@ -331,15 +933,12 @@ class hunk(object):
             self.lenb = int(self.lenb)
         self.starta = int(self.starta)
         self.startb = int(self.startb)
-        diffhelpers.addlines(lr, self.hunk, self.lena, self.lenb, self.a, self.b)
-        # if we hit eof before finishing out the hunk, the last line will
-        # be zero length.  Lets try to fix it up.
-        while len(self.hunk[-1]) == 0:
-            del self.hunk[-1]
-            del self.a[-1]
-            del self.b[-1]
-            self.lena -= 1
-            self.lenb -= 1
+        try:
+            lr.pos = diffhelpers.addrun(lr.lines, lr.pos, self.hunk,
+                                        self.lena, self.lenb, self.a, self.b)
+        except IndexError:
+            raise TruncatedPatch(_("malformed patch, hunk #%d cut short") %
+                                 self.number)
 
     def read_context_hunk(self, lr):
         self.desc = lr.readline()
@@ -355,6 +954,9 @@ class hunk(object):
             self.lena += 1
         for x in xrange(self.lena):
             l = lr.readline()
+            if not l:
+                raise TruncatedPatch(_("malformed patch, hunk #%d cut short")
+                                     % self.number)
             if l.startswith('---'):
                 lr.push(l)
                 break
@@ -440,10 +1042,55 @@ class hunk(object):
 
     def fix_newline(self):
         diffhelpers.fix_newline(self.hunk, self.a, self.b)
+        self.atext = None
+
+    def reverse(self):
+        # swap the old and new sides, turning the hunk into its inverse
+        self.starta, self.startb = self.startb, self.starta
+        self.lena, self.lenb = self.lenb, self.lena
+        self.create, self.remove = self.remove, self.create
+        self.a = []
+        self.b = []
+        self.atext = None
+        for x in xrange(1, len(self.hunk)):
+            l = self.hunk[x]
+            c = l[0]
+            if c == '-':
+                l = '+' + l[1:]
+                self.b.append(l[1:])
+            elif c == '+':
+                l = '-' + l[1:]
+                self.a.append(l)
+            else:
+                self.a.append(l)
+                self.b.append(l[1:])
+            self.hunk[x] = l
+        self.desc = "@@ -%d,%d +%d,%d @@\n" % (self.starta, self.lena,
+                                             self.startb, self.lenb)
+        self.hunk[0] = self.desc
 
     def complete(self):
         return len(self.a) == self.lena and len(self.b) == self.lenb
 
+    def newstart(self):
+        # like oldstart(), for the new lines
+        if self.lenb:
+            return max(self.startb - 1, 0)
+        return self.startb
+
+    def atbottom(self):
+        # context above the changes but none below: the hunk was cut
+        # short by the end of the file. Hunks of diffs made without
+        # context have none on either side.
+        return self.hunk[-1][0] != ' ' and self.hunk[1][0] == ' '
+
+    def oldstart(self):
+        # index of the first old line; "@@ -5,0" inserts after line 5,
+        # zero length ranges already start at the line before them
+        if self.lena:
+            return max(self.starta - 1, 0)
+        return self.starta
+
     def createfile(self):
         return self.starta == 0 and self.lena == 0 and self.create
 
@@ -490,6 +1137,12 @@ class hunk(object):
     def old(self, fuzz=0, toponly=False):
         return self.fuzzit(self.a, fuzz, toponly)
 
+    def oldtext(self, fuzz=0, toponly=False):
+        # like old(), without the leading ' ' or '-' of each line
+        if self.atext is None:
+            self.atext = [l[1:] for l in self.a]
+        return self.fuzzit(self.atext, fuzz, toponly)
+
     def newctrl(self):
         res = []
         for x in self.hunk:
@@ -501,6 +1154,173 @@ class hunk(object):
     def new(self, fuzz=0, toponly=False):
         return self.fuzzit(self.b, fuzz, toponly)
 
+class binhunk(object):
+    """A git binary patch, either a literal or a delta.
+
+    Payload lines are base85-decoded one at a time and fed to an
+    incremental zlib decompressor. Literals are decompressed while
+    reading the patch; deltas are kept compressed and only inflated,
+    piece by piece, while being applied.
+    """
+    def __init__(self, gitpatch, num=0):
+        self.gitpatch = gitpatch
+        self.number = num
+        self.text = None
+        self.delta = None
+        self.size = None
+        self.hunk = ['GIT binary patch\n']
+
+    def createfile(self):
+        return self.gitpatch.op in ('ADD', 'RENAME', 'COPY')
+
+    def rmfile(self):
+        return self.gitpatch.op == 'DELETE'
+
+    def complete(self):
+        return self.text is not None or self.delta is not None
+
+    def reverse(self):
+        raise PatchError(_('cannot reverse binary patch for %s')
+                         % self.gitpatch.path)
+
+    def _decodelines(self, lr):
+        # yield the decoded payload lines, up to the blank line ending it
+        line = lr.readline()
+        while len(line.rstrip('\r\n')) > 0:
+            l = line[0]
+            if l <= 'Z' and l >= 'A':
+                l = ord(l) - ord('A') + 1
+            else:
+                l = ord(l) - ord('a') + 27
+            try:
+                yield base85.b85decode(line[1:].rstrip('\r\n'))[:l]
+            except (TypeError, OverflowError), err:
+                raise PatchError(_('bad binary patch: %s') % err)
+            line = lr.readline()
+
+    def extract(self, lr):
+        line = lr.readline()
+        self.hunk.append(line)
+        while line and not (line.startswith('literal ') or
+                            line.startswith('delta ')):
+            line = lr.readline()
+            self.hunk.append(line)
+        if not line:
+            raise PatchError(_('could not extract binary patch'))
+        kind, size = line.split()
+        self.size = int(size)
+        if kind == 'delta':
+            self.delta = list(self._decodelines(lr))
+            return
+        dec = zlib.decompressobj()
+        text = []
+        try:
+            for data in self._decodelines(lr):
+                text.append(dec.decompress(data))
+            text.append(dec.flush())
+        except zlib.error, err:
+            raise PatchError(_('bad binary patch: %s') % err)
+        text = ''.join(text)
+        if len(text) != self.size:
+            raise PatchError(_('binary patch is %d bytes, not %d') %
+                             (len(text), self.size))
+        self.text = text
+
+    def _inflate(self):
+        dec = zlib.decompressobj()
+        try:
+            for data in self.delta:
+                data = dec.decompress(data)
+                if data:
+                    yield data
+            yield dec.flush()
+        except zlib.error, err:
+            raise PatchError(_('bad binary patch: %s') % err)
+
+    def apply(self, data):
+        """return the new content of a file whose content was data"""
+        if self.delta is None:
+            return self.text
+        return applybindelta(self._inflate(), data, self.size)
+
+class deltareader(object):
+    # reads bytes from a delta coming in pieces of any size
+    def __init__(self, pieces):
+        self.pieces = iter(pieces)
+        self.buf = ''
+        self.pos = 0
+
+    def read(self, n):
+        while len(self.buf) - self.pos < n:
+            piece = next(self.pieces, None)
+            if piece is None:
+                break
+            self.buf = self.buf[self.pos:] + piece
+            self.pos = 0
+        s = self.buf[self.pos:self.pos + n]
+        self.pos += len(s)
+        return s
+
+    def varint(self):
+        i = 0
+        shift = 0
+        while True:
+            c = self.read(1)
+            if not c:
+                raise PatchError(_('truncated binary delta'))
+            c = ord(c)
+            i |= (c & 0x7f) << shift
+            shift += 7
+            if not c & 0x80:
+                return i
+
+def applybindelta(pieces, data, size=None):
+    """Apply a git binary delta to data and return the result.
+
+    'pieces' iterates over the inflated delta, which is consumed as it
+    comes, so only the result and a few delta bytes are held at once.
+    The algorithm is git's patch-delta.c.
+    """
+    delta = deltareader(pieces)
+    srcsize = delta.varint()
+    dstsize = delta.varint()
+    if srcsize != len(data):
+        raise PatchError(_('binary delta expects %d bytes, not %d') %
+                         (srcsize, len(data)))
+    out = []
+    outsize = 0
+    while True:
+        cmd = delta.read(1)
+        if not cmd:
+            break
+        cmd = ord(cmd)
+        if cmd & 0x80:
+            offset = 0
+            size = 0
+            for bit, shift in ((0x01, 0), (0x02, 8), (0x04, 16), (0x08, 24)):
+                if cmd & bit:
+                    offset |= ord(delta.read(1) or '\0') << shift
+            for bit, shift in ((0x10, 0), (0x20, 8), (0x40, 16)):
+                if cmd & bit:
+                    size |= ord(delta.read(1) or '\0') << shift
+            if size == 0:
+                size = 0x10000
+            if offset + size > len(data):
+                raise PatchError(_('binary delta copies past the source'))
+            out.append(data[offset:offset + size])
+        elif cmd != 0:
+            s = delta.read(cmd)
+            if len(s) != cmd:
+                raise PatchError(_('truncated binary delta'))
+            out.append(s)
+        else:
+            raise PatchError(_('unexpected delta opcode 0'))
+        outsize += len(out[-1])
+    if outsize != dstsize:
+        raise PatchError(_('binary delta gives %d bytes, not %d') %
+                         (outsize, dstsize))
+    return ''.join(out)
+
 def parsefilename(str):
     # --- filename \t|space stuff
     s = str[4:].rstrip('\r\n')
@@ -511,48 +1331,27 @@ def parsefilename(str):
             return s
     return s[:i]
 
-def scangitpatch(lr, firstline):
-    """
-    Git patches can emit:
-    - rename a to b
-    - change b
-    - copy a to c
-    - change c
-
-    We cannot apply this sequence as-is, the renamed 'a' could not be
-    found for it would have been renamed already. And we cannot copy
-    from 'b' instead because 'b' would have been changed already. So
-    we scan the git patch for copy and rename commands so we can
-    perform the copies ahead of time.
-    """
-    pos = 0
-    try:
-        pos = lr.fp.tell()
-        fp = lr.fp
-    except IOError:
-        fp = cStringIO.StringIO(lr.fp.read())
-    gitlr = linereader(fp, lr.textmode)
-    gitlr.push(firstline)
-    (dopatch, gitpatches) = readgitpatch(gitlr)
-    fp.seek(pos)
-    return dopatch, gitpatches
-
-def iterhunks(ui, fp, sourcefile=None, textmode=False):
+def iterhunks(ui, fp, sourcefile=None, textmode=False, reverse=False):
     """Read a patch and yield the following events:
     - ("file", afile, bfile, firsthunk): select a new target file.
     - ("hunk", hunk): a new hunk is ready to be applied, follows a
     "file" event.
     - ("git", gitchanges): current diff is in git format, gitchanges
-    maps filenames to gitpatch records. Unique event.
+    lists its gitpatch records. Unique event, comes last: the records
+    are read along with the hunks, in a single pass.
 
     If textmode is True, input line-endings are normalized to LF.
+    If reverse is True, hunks are reversed as they are read.
     """
     changed = {}
+    gitpatches = []
     current_hunk = None
     afile = ""
     bfile = ""
     state = None
     hunknum = 0
+    # hunks in the whole patch, hunknum counts them per file
+    nhunks = 0
     emitfile = False
     git = False
 
@@ -574,6 +1373,8 @@ def iterhunks(ui, fp, sourcefile=None, textmode=False):
         if current_hunk:
             if x.startswith('\ '):
                 current_hunk.fix_newline()
+            if reverse:
+                current_hunk.reverse()
             yield 'hunk', current_hunk
             current_hunk = None
             gitworkdone = False
@@ -585,38 +1386,53 @@ def iterhunks(ui, fp, sourcefile=None, textmode=False):
                 gpatch = changed.get(bfile)
                 create = afile == '/dev/null' or gpatch and gpatch.op == 'ADD'
                 remove = bfile == '/dev/null' or gpatch and gpatch.op == 'DELETE'
+                start = timer()
                 current_hunk = hunk(x, hunknum + 1, lr, context, create, remove)
+                if ui.stats is not None:
+                    ui.stats.hunkparsed(current_hunk, timer() - start)
+            except TruncatedPatch:
+                # never apply the hunks before it on their own
+                raise
             except PatchError, err:
                 ui.debug(err)
                 current_hunk = None
                 continue
             hunknum += 1
+            nhunks += 1
             if emitfile:
                 emitfile = False
                 yield 'file', (afile, bfile, current_hunk)
         elif state == BFILE and x.startswith('GIT binary patch'):
-            raise NotImplementedError
-            current_hunk = binhunk(changed[bfile])
+            gp = changed[bfile]
+            gp.binary = True
+            dopatch |= GP_BINARY
+            current_hunk = binhunk(gp, hunknum + 1)
             hunknum += 1
+            nhunks += 1
             if emitfile:
                 emitfile = False
                 yield 'file', ('a/' + afile, 'b/' + bfile, current_hunk)
             current_hunk.extract(lr)
         elif x.startswith('diff --git'):
-            # check for git diff, scanning the whole patch file if needed
             m = gitre.match(x)
             if m:
                 afile, bfile = m.group(1, 2)
                 if not git:
                     git = True
-                    dopatch, gitpatches = scangitpatch(lr, x)
-                    yield 'git', gitpatches
-                    for gp in gitpatches:
-                        changed[gp.path] = gp
-                # else error?
+                    # can have a git patch with only metadata
+                    dopatch = 0
+                gp = patchmeta(bfile)
+                gp.lineno = lr.pos
+                # the extended headers follow right away
+                while True:
+                    l = lr.readline()
+                    if not githeader(gp, l.rstrip(' \r\n')):
+                        lr.push(l)
+                        break
+                gitpatches.append(gp)
+                changed[gp.path] = gp
                 # copy/rename + modify should modify target, not source
-                gp = changed.get(bfile)
-                if gp and gp.op in ('COPY', 'DELETE', 'RENAME', 'ADD'):
+                if gp.op in ('COPY', 'DELETE', 'RENAME', 'ADD'):
                     afile = bfile
                     gitworkdone = True
             newfile = True
@@ -630,6 +1446,8 @@ def iterhunks(ui, fp, sourcefile=None, textmode=False):
             context = False
             afile = parsefilename(x)
             bfile = parsefilename(l2)
+            if git:
+                dopatch |= GP_PATCH
         elif x.startswith('***'):
             # check for a context diff
             l2 = lr.readline()
@@ -652,89 +1470,613 @@ def iterhunks(ui, fp, sourcefile=None, textmode=False):
             hunknum = 0
     if current_hunk:
         if current_hunk.complete():
+            if reverse:
+                current_hunk.reverse()
             yield 'hunk', current_hunk
         else:
             raise PatchError(_("malformed patch %s %s") % (afile,
                              current_hunk.desc))
+    if git:
+        # copies and renames are only carried out once the whole patch
+        # is read, see applyfilemap()
+        yield 'git', gitpatches
 
-    if hunknum == 0 and dopatch and not gitworkdone:
+    if nhunks == 0 and dopatch and not gitworkdone:
         raise NoHunks
 
 class UIDummy(object):
     verbose = False
+    stats = None
     def note(self, s): pass
-
-def applydiff_hacked(patch_str, targetfile, changed, strip=1, sourcefile=None, eol='\n'):
+    def warn(self, s): pass
+    def debug(self, s): pass
+
+class patchui(object):
+    """ui keeping the messages of the patching code in 'messages' and
+    reporting hunks to 'stats', a stats.patchstats or anything with
+    the same hunkparsed() and hunkapplied() methods. Notes are only
+    kept if 'verbose' is True.
     """
-    Reads a patch from fp and tries to apply it.
+    def __init__(self, stats=None, verbose=False):
+        self.stats = stats
+        self.verbose = verbose
+        self.messages = []
 
-    The dict 'changed' is filled in with all of the filenames changed
-    by the patch. Returns 0 for a clean patch, -1 if any rejects were
-    found and 1 if there was any fuzz.
+    def note(self, s):
+        if self.verbose:
+            self.messages.append(s)
 
-    If 'eol' is None, the patch content and patched file are read in
-    binary mode. Otherwise, line endings are ignored when patching then
-    normalized to 'eol' (usually '\n' or \r\n').
-    """
+    def warn(self, s):
+        self.messages.append(s)
 
-    from StringIO import StringIO
+    def debug(self, s):
+        if self.verbose:
+            self.messages.append(str(s))
 
-    fp = StringIO(patch_str)
-    ui = UIDummy()
-
-    rejects = 0
-    err = 0
-    current_file = None
-    gitpatches = None
-    textmode = eol is not None
+def readpatch(ui, fp, sourcefile=None, textmode=False, reverse=False):
+    """Read a whole patch from fp.
 
-    def closefile():
-        if not current_file:
-            return 0
-        current_file.close()
-        return len(current_file.rej)
-
-    one_file = False
-    for state, values in iterhunks(ui, fp, sourcefile, textmode):
+    Returns a (gitpatches, files) tuple. 'gitpatches' lists the git
+    metadata records, it is empty for plain diffs. 'files' lists the
+    patched files in patch order, as (afile, bfile, hunks) tuples. With
+    'reverse' set, the hunks undo the patch instead.
+    """
+    gitpatches = []
+    files = []
+    hunks = None
+    for state, values in iterhunks(ui, fp, sourcefile, textmode, reverse):
         if state == 'hunk':
-            if not current_file:
-                continue
-            current_hunk = values
-            ret = current_file.apply(current_hunk)
-            if ret >= 0:
-                changed.setdefault(current_file.fname, None)
-                if ret > 0:
-                    err = 1
+            if hunks is not None:
+                hunks.append(values)
         elif state == 'file':
-            if one_file is not False:
-                raise ValueError('Expected only one file!')
-            else:
-                one_file = True
-
-            rejects += closefile()
             afile, bfile, first_hunk = values
-            try:
-                #current_file, missing = selectfile(afile, bfile, first_hunk,
-                #                        strip)
-                #current_file = patchfile(ui, current_file, opener, missing, eol)
-                current_file = patchfile(ui, current_file, targetfile, False, eol)
-            except PatchError, err:
-                ui.warn(str(err) + '\n')
-                current_file, current_hunk = None, None
-                rejects += 1
-                continue
+            hunks = []
+            files.append((afile, bfile, hunks))
         elif state == 'git':
             gitpatches = values
-            cwd = os.getcwd()
-            for gp in gitpatches:
-                if gp.op in ('COPY', 'RENAME'):
-                    copyfile(gp.oldpath, gp.path, cwd)
-                changed[gp.path] = gp
+    return gitpatches, files
+
+class parsecache(object):
+    """Bounded LRU cache of readpatch() results, keyed by patch digest.
+
+    At most 'maxentries' patches totalling at most 'maxsize' characters
+    of patch text are kept; a limit of 0 disables the cache. 'hits' and
+    'misses' count lookups since the last clear().
+    """
+    def __init__(self, maxentries=32, maxsize=4 << 20):
+        self.maxentries = maxentries
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self._lock.release()
+
+    def resize(self, maxentries, maxsize):
+        self._lock.acquire()
+        try:
+            self.maxentries = maxentries
+            self.maxsize = maxsize
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.maxentries or
+                                 self.size > self.maxsize):
+            key, (size, parsed) = self._entries.popitem(last=False)
+            self.size -= size
+
+    def readpatch(self, ui, patch_str, sourcefile=None, textmode=False,
+                  reverse=False):
+        """Like readpatch(), from the string 'patch_str'. The returned
+        hunks are shared between callers and must not be modified."""
+        if not self.maxentries or len(patch_str) > self.maxsize:
+            return readpatch(ui, StringIO(patch_str), sourcefile, textmode,
+                             reverse)
+        data = patch_str
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        key = (hashlib.sha1(data).digest(), type(patch_str), sourcefile,
+               textmode, reverse)
+        if textmode and '\r\n' in patch_str:
+            # normalize in one go rather than line by line
+            patch_str = patch_str.replace('\r\n', '\n')
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+        gitpatches, files = readpatch(ui, StringIO(patch_str), sourcefile,
+                                      textmode, reverse)
+        parsed = (tuple(gitpatches),
+                  tuple((afile, bfile, tuple(hunks))
+                        for afile, bfile, hunks in files))
+        self._lock.acquire()
+        try:
+            if key not in self._entries:
+                self._entries[key] = (len(patch_str), parsed)
+                self.size += len(patch_str)
+                self._evict()
+        finally:
+            self._lock.release()
+        return parsed
+
+# parsed patches reused by applydiff_hacked()
+hunkcache = parsecache()
+
+def pathstrip(path, count=1):
+    pathlen = len(path)
+    i = 0
+    if count == 0:
+        return '', path.rstrip()
+    while count > 0:
+        i = path.find('/', i)
+        if i == -1:
+            raise PatchError(_("unable to strip away %d dirs from %s") %
+                             (count, path))
+        i += 1
+        # consume '//' in the path
+        while i < pathlen - 1 and path[i] == '/':
+            i += 1
+        count -= 1
+    return path[:i].lstrip(), path[i:].rstrip()
+
+def selectfile(afile_orig, bfile_orig, hunk, strip, exists):
+    """Pick the file a patch section applies to.
+
+    'exists' is called with a stripped path and tells whether that
+    file is available. Returns a (fname, missing, create) tuple,
+    'create' telling whether the first hunk of the section, 'hunk',
+    creates the file. 'hunk' is left untouched.
+    """
+    nulla = afile_orig == "/dev/null"
+    nullb = bfile_orig == "/dev/null"
+    abase, afile = pathstrip(afile_orig, strip)
+    gooda = not nulla and exists(afile)
+    bbase, bfile = pathstrip(bfile_orig, strip)
+    if afile == bfile:
+        goodb = gooda
+    else:
+        goodb = not nullb and exists(bfile)
+    create = hunk.createfile()
+    missing = not goodb and not gooda and not create
+
+    # some diff programs apparently produce create patches where the
+    # afile is not /dev/null, but rather the same name as the bfile
+    if (missing and afile == bfile and not isinstance(hunk, binhunk) and
+        hunk.starta == 0 and hunk.lena == 0):
+        create = True
+        missing = False
+
+    # If afile is "a/b/foo" and bfile is "a/b/foo.orig" we assume the
+    # diff is between a file and its backup. In this case, the original
+    # file should be patched (see original mpatch code).
+    isbackup = (abase == bbase and bfile.startswith(afile))
+    fname = None
+    if not missing:
+        if gooda and goodb:
+            fname = isbackup and afile or bfile
+        elif gooda:
+            fname = afile
+
+    if not fname:
+        if not nullb:
+            fname = isbackup and afile or bfile
+        elif not nulla:
+            fname = afile
         else:
-            raise util.Abort(_('unsupported parser state: %s') % state)
+            raise PatchError(_("undefined source and destination files"))
 
-    rejects += closefile()
+    return fname, missing, create
 
-    if rejects:
-        return -1
+def applyfile(args):
+    """Apply hunks to the content of a single file.
+
+    'args' is a (fname, content, sections, eol) tuple, packed so this
+    can be handed to a pool's map(). 'sections' is a list of hunk
+    lists, one per patch section touching the file. Returns a (fname,
+    content, rejects, fuzz) tuple, 'content' being None if the patch
+    removed the file.
+    """
+    fname, content, sections, eol = args
+    ui = UIDummy()
+    targetfile = StringIO(content)
+    current_file = patchfile(ui, fname, targetfile, False, eol)
+    err = 0
+    for hunks in sections:
+        # each section counts lines from the output of the previous one
+        current_file.offset = 0
+        current_file.skew = 0
+        for ret in current_file.applyhunks(hunks):
+            if ret > 0:
+                err = 1
+    if current_file.removed:
+        return fname, None, len(current_file.rej), err
+    current_file.write()
+    return fname, targetfile.getvalue(), len(current_file.rej), err
+
+def applyfilemap(ui, gitpatches, files, filemap, strip=1, eol='\n',
+                 workers=None, pool=None):
+    """Apply a parsed patch to the {path: content} dict 'filemap'.
+
+    'gitpatches' and 'files' are what readpatch() returns. Files are
+    patched concurrently with 'pool', any object with a map() method
+    such as multiprocessing.Pool or multiprocessing.pool.ThreadPool.
+    Without one, a process pool of 'workers' processes is used when
+    more than one file is patched.
+
+    Returns a new dict, 'filemap' is left untouched. Raises PatchError
+    if a target file is missing or any hunk fails.
+    """
+    result = dict(filemap)
+    # copies and renames read from the original files, so they are
+    # unaffected by whatever the patch does to their sources
+    for gp in gitpatches:
+        if gp.op in ('COPY', 'RENAME'):
+            if gp.oldpath not in filemap:
+                raise PatchError(_("unable to find '%s' for copying") %
+                                 gp.oldpath)
+            result[gp.path] = filemap[gp.oldpath]
+    for gp in gitpatches:
+        if gp.op == 'RENAME' and gp.oldpath != gp.path:
+            del result[gp.oldpath]
+        elif gp.op == 'ADD':
+            result.setdefault(gp.path, '')
+
+    jobs = []
+    sections = {}
+    for afile, bfile, hunks in files:
+        if not hunks:
+            continue
+        fname, missing, create = selectfile(afile, bfile, hunks[0], strip,
+                                            result.__contains__)
+        if missing:
+            raise PatchError(_("unable to find '%s' for patching") % fname)
+        if create and not hunks[0].createfile():
+            # parsed hunks may be shared through the cache, flag a copy
+            first = copy.copy(hunks[0])
+            first.create = True
+            hunks = [first] + list(hunks[1:])
+        if fname not in sections:
+            sections[fname] = []
+            jobs.append((fname, result.get(fname, ''), sections[fname], eol))
+        sections[fname].append(hunks)
+
+    if pool is not None:
+        results = pool.map(applyfile, jobs)
+    elif len(jobs) > 1 and workers != 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(applyfile, jobs)
+        finally:
+            pool.terminate()
+    else:
+        results = map(applyfile, jobs)
+
+    failed = []
+    for fname, content, rejects, err in results:
+        if rejects:
+            failed.append(fname)
+        elif content is None:
+            result.pop(fname, None)
+        else:
+            result[fname] = content
+    if failed:
+        raise PatchError(_("hunks FAILED in %s") % ', '.join(failed))
+    for gp in gitpatches:
+        if gp.op == 'DELETE':
+            result.pop(gp.path, None)
+    return result
+
+def hunksordered(hunks):
+    """True if 'hunks' can be applied one after the other: text hunks
+    in ascending order, none of them overlapping the next one"""
+    end = 0
+    for h in hunks:
+        if isinstance(h, binhunk) or h.createfile() or h.rmfile():
+            return True
+        if h.oldstart() < end:
+            return False
+        end = h.oldstart() + h.lena
+    return True
+
+def applyparsed(ui, gitpatches, files, targetfile, changed, eol='\n',
+                locate=False, plan=None):
+    """Apply a patch parsed by readpatch() to the file object
+    'targetfile'. See applydiff_hacked() for 'changed', 'eol', 'locate'
+    and the return value.
+
+    Hunks that are out of order or overlap go through
+    patchfile.applyplanned(); 'plan' forces it on or off.
+    """
+    if len(files) > 1:
+        raise ValueError('Expected only one file!')
+    for gp in gitpatches:
+        changed[gp.path] = gp
+    if not files:
+        return 0
+
+    err = 0
+    afile, bfile, hunks = files[0]
+    current_file = patchfile(ui, None, targetfile, False, eol)
+    if locate:
+        current_file.locate(hunks)
+    for ret in current_file.applyhunks(hunks, plan):
+        if ret >= 0:
+            changed.setdefault(current_file.fname, None)
+            if ret > 0:
+                err = 1
+    current_file.close()
     return err
+
+def checkparsed(ui, gitpatches, files, targetfile, eol='\n'):
+    """Tell how a patch parsed by readpatch() would apply to the file
+    object 'targetfile', which is left untouched.
+
+    Hunks go through the same search as applyparsed(), their edits are
+    only recorded in the line index and the patched text is never built.
+    Returns a stats.hunkstat per hunk, in patch order.
+    """
+    if len(files) > 1:
+        raise ValueError('Expected only one file!')
+    if not files:
+        return []
+    collected = patchstats()
+    checkui = patchui(collected, ui.verbose)
+    current_file = patchfile(checkui, None, targetfile, False, eol)
+    current_file.applyhunks(files[0][2])
+    for m in checkui.messages:
+        ui.warn(m)
+    return collected.applied
+
+def applyseries(ui, series, targetfile, eol='\n', checkpoints=None):
+    """Apply a series of parsed patches to the file object 'targetfile'.
+
+    'series' iterates over (gitpatches, files) tuples as returned by
+    readpatch(), each patch touching a single file and expressed
+    against the output of the previous one. All of them go through a
+    single patchfile, so the text is split once and only joined at the
+    end. Keys of the dict 'checkpoints' are indices in the series, the
+    text right after that patch is stored under them. Raises PatchError
+    at the first patch with rejected hunks.
+    """
+    current_file = patchfile(ui, None, targetfile, False, eol)
+    for x, (gitpatches, files) in enumerate(series):
+        if len(files) > 1:
+            raise ValueError('Expected only one file!')
+        # each patch counts lines from the output of the previous one
+        current_file.offset = 0
+        current_file.skew = 0
+        if files:
+            current_file.applyhunks(files[0][2])
+        if current_file.rej:
+            raise PatchError(_("patch %d of the series: %d out of %d hunks "
+                               "FAILED") % (x, len(current_file.rej),
+                                            current_file.hunks))
+        current_file.hunks = 0
+        if checkpoints is not None and x in checkpoints:
+            checkpoints[x] = current_file.getvalue()
+    current_file.write()
+
+def iterpatched(ui, hunks, lines, eol='\n', window=100, chunklines=1024):
+    """Apply 'hunks' to the iterable 'lines', yielding the result.
+
+    This is a streaming variant of patchfile for large inputs: hunks
+    must come in order and apply without fuzz, at most 'window' lines
+    away from their stated position. Only the lines in that window are
+    kept in memory. Output comes as strings of up to 'chunklines' whole
+    lines. A hunk that does not apply raises PatchError, possibly after
+    part of the output has been yielded.
+    """
+    if eol == 'keep':
+        raise ValueError("eol 'keep' cannot be streamed")
+    lines = iter(lines)
+    if eol is not None:
+        lines = (l[-2:] == '\r\n' and l[:-2] + '\n' or l for l in lines)
+
+    def out(ls):
+        s = ''.join(ls)
+        if eol and eol != '\n':
+            s = s.replace('\n', eol)
+        return s
+
+    buf = []
+    # original position of buf[0]
+    pos = 0
+    offset = 0
+    for h in hunks:
+        if isinstance(h, binhunk):
+            raise PatchError(_("binary hunk #%d cannot be streamed") %
+                             h.number)
+        if not h.complete():
+            raise PatchError(_("bad hunk #%d %s (%d %d %d %d)") %
+                            (h.number, h.desc, len(h.a), h.lena, len(h.b),
+                            h.lenb))
+        old = h.oldtext()
+        orig_start = h.oldstart()
+        start = orig_start + offset
+
+        # pass through whatever comes before the search window
+        while pos + len(buf) < start - window:
+            l = next(lines, None)
+            if l is None:
+                break
+            buf.append(l)
+            if len(buf) >= chunklines:
+                yield out(buf)
+                pos += len(buf)
+                buf = []
+        skip = min(len(buf), start - window - pos)
+        if skip > 0:
+            yield out(buf[:skip])
+            del buf[:skip]
+            pos += skip
+
+        while pos + len(buf) < start + len(old) + window:
+            l = next(lines, None)
+            if l is None:
+                break
+            buf.append(l)
+
+        found = None
+        for d in xrange(window + 1):
+            for l in (start - d, start + d):
+                x = l - pos
+                if x >= 0 and buf[x:x + len(old)] == old:
+                    found = l
+                    break
+            if found is not None:
+                break
+        if found is None:
+            raise PatchError(_("Hunk #%d FAILED at %d") %
+                             (h.number, orig_start))
+
+        x = found - pos
+        if x:
+            yield out(buf[:x])
+        yield out(h.new())
+        del buf[:x + len(old)]
+        pos = found + len(old)
+        offset = found - orig_start
+
+    while True:
+        while len(buf) < chunklines:
+            l = next(lines, None)
+            if l is None:
+                break
+            buf.append(l)
+        if not buf:
+            break
+        yield out(buf)
+        buf = []
+
+def applybuffer(ui, hunks, buf, fp=None):
+    """Apply hunks to a buffer with bufferfile, writing the result to
+    fp, or returning it if fp is None"""
+    current_file = bufferfile(ui, buf)
+    for h in hunks:
+        current_file.apply(h)
+    if current_file.rej:
+        raise PatchError(_("%d out of %d hunks FAILED") %
+                         (len(current_file.rej), current_file.hunks))
+    if fp is not None:
+        current_file.write(fp)
+        return None
+    fp = cStringIO.StringIO()
+    current_file.write(fp)
+    return fp.getvalue()
+
+def applydiff_hacked(patch_str, targetfile, changed, strip=1, sourcefile=None, eol='\n',
+                     ui=None, reverse=False, locate=False):
+    """
+    Reads a patch from fp and tries to apply it.
+
+    The dict 'changed' is filled in with all of the filenames changed
+    by the patch. Returns 0 for a clean patch and 1 if there was any
+    fuzz. Raises PatchError if any hunk was rejected.
+
+    If 'eol' is None, the patch content and patched file are read in
+    binary mode. Otherwise, line endings are ignored when patching then
+    normalized to 'eol' (usually '\n' or \r\n'). With 'keep', lines
+    keep the ending they had, new ones get the one most used in the
+    file.
+
+    'ui' receives messages and statistics, see patchui. With 'reverse'
+    set, the patch is undone: its hunks are reversed while parsing, then
+    applied as usual.
+
+    With 'locate' set, all hunks are first looked for in a single
+    rolling hash scan of the target (see patchfile.locate()), which
+    pays off when most of them moved.
+    """
+    if ui is None:
+        ui = UIDummy()
+    gitpatches, files = hunkcache.readpatch(ui, patch_str, sourcefile,
+                                            eol is not None, reverse)
+    return applyparsed(ui, gitpatches, files, targetfile, changed, eol,
+                       locate)
+
+class compiledpatch(object):
+    """A patch parsed once, ready to be applied to many originals.
+
+    Hunks are only read while applying, so the parsed patch can be
+    shared by any number of apply() calls, including concurrent ones.
+    """
+    def __init__(self, patch_str, sourcefile=None, eol='\n', parsed=None):
+        # 'parsed' replaces 'patch_str' with what readpatch() returns
+        if parsed is not None:
+            gitpatches, files = parsed
+        else:
+            ui = UIDummy()
+            gitpatches, files = readpatch(ui, StringIO(patch_str),
+                                          sourcefile, eol is not None)
+        self._gitpatches = tuple(gitpatches)
+        self._files = tuple((afile, bfile, tuple(hunks))
+                            for afile, bfile, hunks in files)
+        self._eol = eol
+
+    gitpatches = property(lambda self: self._gitpatches)
+    files = property(lambda self: self._files)
+    eol = property(lambda self: self._eol)
+
+    def apply(self, original):
+        """Apply the patch to the string 'original' and return the
+        result. The patch must touch a single file. Raises PatchError
+        if any hunk fails."""
+        targetfile = StringIO(original)
+        applyparsed(UIDummy(), self._gitpatches, self._files, targetfile,
+                    {}, self._eol)
+        return targetfile.getvalue()
+
+    def apply_many(self, originals):
+        """Apply the patch to each string of 'originals', yielding the
+        results in order."""
+        for original in originals:
+            yield self.apply(original)
+
+    def iter_apply(self, original, window=100):
+        """Apply the patch to 'original', an iterable of lines such as
+        an open file, yielding the result in chunks. See iterpatched()
+        for the restrictions."""
+        if len(self._files) > 1:
+            raise ValueError('Expected only one file!')
+        hunks = self._files and self._files[0][2] or ()
+        return iterpatched(UIDummy(), hunks, original, self._eol, window)
+
+    def apply_buffer(self, buf, fp=None):
+        """Apply the patch to a str, mmap or memoryview without splitting
+        it into lines, see bufferfile. The result is written to the file
+        object 'fp', or returned if there is none. Raises PatchError if
+        any hunk fails."""
+        if len(self._files) > 1:
+            raise ValueError('Expected only one file!')
+        return applybuffer(UIDummy(), self._files and self._files[0][2] or (),
+                           buf, fp)
+
+    def apply_files(self, files, strip=1, workers=None, pool=None):
+        """Apply the patch to the {path: content} dict 'files', see
+        applyfilemap()."""
+        return applyfilemap(UIDummy(), self._gitpatches, self._files, files,
+                            strip, self._eol, workers, pool)
@@ -0,0 +1,129 @@
+# stats.py - per-hunk statistics for patch parsing and application
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+class hunkstat(object):
+    """What happened when a hunk was applied.
+
+    'fuzz' is the fuzz level used, -1 if the hunk failed. 'position' is
+    the line where the hunk applied, counting from 1, and 'offset' how
+    far that is from where the hunk said it would be; both are None if
+    the hunk failed. 'candidates' counts the positions tested by the
+    offset and fuzz search, 'hashtime' the seconds spent indexing the
+    file for it.
+    """
+    def __init__(self, number, fastpath, candidates, fuzz, position,
+                 offset, applytime, hashtime):
+        self.number = number
+        self.fastpath = fastpath
+        self.candidates = candidates
+        self.fuzz = fuzz
+        self.position = position
+        self.offset = offset
+        self.applytime = applytime
+        self.hashtime = hashtime
+
+    def status(self):
+        if self.fuzz < 0:
+            return 'failed'
+        if self.fuzz:
+            return 'fuzz'
+        if self.offset:
+            return 'offset'
+        return 'exact'
+
+    def __repr__(self):
+        return '<hunkstat #%d %s at %r>' % (self.number, self.status(),
+                                            self.position)
+
+class patchstats(object):
+    """Observer collecting statistics about parsed and applied hunks.
+
+    Hand it to a ui (see patch.patchui) to have iterhunks() report
+    every parsed hunk to hunkparsed() and patchfile.apply() every
+    applied one to hunkapplied(). Subclasses may override these to
+    watch hunks as they go. Per-hunk records are kept in 'parsed' and
+    'applied' unless 'keep' is False; the totals always are.
+    """
+    def __init__(self, keep=True):
+        self.keep = keep
+        self.parsed = []
+        self.applied = []
+        self.hunksparsed = 0
+        self.parsetime = 0.0
+        self.applytime = 0.0
+        self.hashtime = 0.0
+        self.candidates = 0
+        self.fastpath = 0
+        self.results = {'exact': 0, 'offset': 0, 'fuzz': 0, 'failed': 0}
+        self.maxoffset = 0
+
+    def hunkparsed(self, h, seconds):
+        self.hunksparsed += 1
+        self.parsetime += seconds
+        if self.keep:
+            self.parsed.append((h.number, seconds))
+
+    def hunkapplied(self, h, stat):
+        self.applytime += stat.applytime
+        self.hashtime += stat.hashtime
+        self.candidates += stat.candidates
+        if stat.fastpath:
+            self.fastpath += 1
+        self.results[stat.status()] += 1
+        if stat.offset is not None:
+            self.maxoffset = max(self.maxoffset, abs(stat.offset))
+        if self.keep:
+            self.applied.append(stat)
+
+    def summary(self):
+        """totals as a dict"""
+        applied = sum(self.results.values())
+        return {
+            'hunks_parsed': self.hunksparsed,
+            'hunks_applied': applied,
+            'fastpath': self.fastpath,
+            'exact': self.results['exact'],
+            'offset': self.results['offset'],
+            'fuzz': self.results['fuzz'],
+            'failed': self.results['failed'],
+            'candidates': self.candidates,
+            'max_offset': self.maxoffset,
+            'parse_seconds': self.parsetime,
+            'apply_seconds': self.applytime,
+            'hashlines_seconds': self.hashtime,
+        }
+
+    def prometheus(self, prefix='hgpatcher'):
+        """totals in the Prometheus text exposition format"""
+        out = []
+        def metric(name, kind, doc, samples):
+            name = '%s_%s' % (prefix, name)
+            out.append('# HELP %s %s\n' % (name, doc))
+            out.append('# TYPE %s %s\n' % (name, kind))
+            for labels, value in samples:
+                out.append('%s%s %r\n' % (name, labels, value))
+
+        metric('hunks_parsed_total', 'counter', 'Hunks parsed.',
+               [('', self.hunksparsed)])
+        metric('hunks_applied_total', 'counter',
+               'Hunks applied, by outcome.',
+               [('{result="%s"}' % r, self.results[r])
+                for r in ('exact', 'offset', 'fuzz', 'failed')])
+        metric('fastpath_hits_total', 'counter',
+               'Hunks applied at their stated position.',
+               [('', self.fastpath)])
+        metric('findlines_candidates_total', 'counter',
+               'Positions tested by the offset and fuzz search.',
+               [('', self.candidates)])
+        metric('max_offset_lines', 'gauge',
+               'Largest offset a hunk applied at.', [('', self.maxoffset)])
+        metric('parse_seconds_total', 'counter',
+               'Time spent parsing hunks.', [('', self.parsetime)])
+        metric('apply_seconds_total', 'counter',
+               'Time spent applying hunks.', [('', self.applytime)])
+        metric('hashlines_seconds_total', 'counter',
+               'Time spent indexing files for the offset search.',
+               [('', self.hashtime)])
+        return ''.join(out)
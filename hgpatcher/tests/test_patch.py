@@ -1,6 +1,18 @@
+import mmap
+import random
+import tempfile
+import threading
 import unittest
+from multiprocessing.pool import ThreadPool
 
-from patchtool import apply_patch
+from StringIO import StringIO
+
+from hgpatcher import apply_patch, apply_patch_buffer, apply_patch_files
+from hgpatcher import apply_batch, apply_patch_async, apply_series, check_patch
+from hgpatcher import compose_patches
+from hgpatcher import compile_diff, compile_patch, iter_patch, make_patch
+from hgpatcher import background, bench, diffhelpers, mdiff, patch, stats
+from hgpatcher.patch import PatchConflict, PatchError
 
 class PatchTest(unittest.TestCase):
     def _do_test(self, original, patch, expected):
@@ -12,6 +24,904 @@ class PatchTest(unittest.TestCase):
     def test_offset_patch(self):
         self._do_test(**test2_data)
 
+class LineReaderTest(unittest.TestCase):
+    def test_push(self):
+        lr = patch.linereader(StringIO('a\r\nb\nc'), textmode=True)
+        self.assertEqual(lr.readline(), 'a\n')
+        l2 = lr.readline()
+        l3 = lr.readline()
+        lr.push(l3)
+        lr.push(l2)
+        self.assertEqual(list(lr), ['b\n', 'c'])
+        # pushing back the end of file
+        lr.push(lr.readline())
+        self.assertEqual(lr.readline(), '')
+
+    def test_addrun(self):
+        lines = [' a\n', '-b\n', '\\ No newline at end of file\n',
+                 '+c\n', '\n', ' d\n', 'tail\n']
+        hunk, a, b = [], [], []
+        pos = diffhelpers.addrun(lines, 0, hunk, 4, 4, a, b)
+        self.assertEqual(lines[pos], 'tail\n')
+        expected = [], [], []
+        diffhelpers.addlines(StringIO(''.join(lines)), expected[0], 4, 4,
+                             expected[1], expected[2])
+        self.assertEqual((hunk, a, b), expected)
+        self.assertEqual(a, [' a\n', '-b', ' \n', ' d\n'])
+
+    def test_cut_short(self):
+        the_patch = '--- a\n+++ b\n@@ -1,3 +1,3 @@\n a\n-b\n'
+        lr = patch.linereader(StringIO(the_patch))
+        lr.pos = 2
+        self.assertRaises(patch.TruncatedPatch, patch.hunk, lr.readline(), 1,
+                          lr, False)
+        self.assertRaises(patch.TruncatedPatch, patch.readpatch,
+                          patch.UIDummy(), StringIO(the_patch))
+        # a complete hunk first must not be applied on its own
+        the_patch = ('--- a\n+++ b\n@@ -1,2 +1,2 @@\n-a\n+x\n b\n'
+                     '@@ -10,3 +10,3 @@\n j\n-k\n')
+        original = ''.join('%s\n' % c for c in 'abcdefghijkl')
+        self.assertRaises(patch.TruncatedPatch, apply_patch, the_patch,
+                          original)
+        context = ('*** a\n--- b\n***************\n*** 1,3 ****\n  a\n')
+        self.assertRaises(patch.TruncatedPatch, patch.readpatch,
+                          patch.UIDummy(), StringIO(context))
+
+class LineIndexTest(unittest.TestCase):
+    def test_random_replacements(self):
+        rnd = random.Random(1)
+        for trial in xrange(200):
+            orig = [rnd.choice('abcd') for x in xrange(rnd.randint(0, 20))]
+            current = list(orig)
+            index = patch.lineindex(orig)
+            for step in xrange(rnd.randint(1, 6)):
+                start = rnd.randint(0, len(current))
+                length = rnd.randint(0, min(3, len(current) - start))
+                lines = [rnd.choice('abcxy') for x in xrange(rnd.randint(0, 3))]
+                index.replace(start, length, lines)
+                current[start:start + length] = lines
+                self.assertEqual(index.getlines(0, len(index)), current)
+                for l in 'abcdxy':
+                    self.assertEqual(index.positions(l),
+                        [x for x, s in enumerate(current) if s == l])
+                    if l in current:
+                        self.assertTrue(index.count(l) > 0)
+
+    def test_nearest(self):
+        orig = list('abacabad')
+        index = patch.lineindex(orig)
+        index.replace(2, 2, ['a', 'x'])
+        current = index.getlines(0, len(index))
+        for l in 'abx':
+            for linenum in xrange(-1, len(current) + 1):
+                expected = [x for x, s in enumerate(current) if s == l]
+                expected.sort(key=lambda x: abs(x - linenum))
+                self.assertEqual(list(index.nearest(l, linenum)), expected)
+
+    def test_offset_hunks(self):
+        self._do_test(**offsets_data)
+
+    def _do_test(self, original, patch, expected):
+        self.assertEqual(apply_patch(patch, original), expected)
+
+class DiffTest(unittest.TestCase):
+    def test_round_trip(self):
+        rnd = random.Random(3)
+        for trial in xrange(300):
+            a = [rnd.choice('abcde') + '\n' for x in xrange(rnd.randint(0, 15))]
+            b = list(a)
+            for k in xrange(rnd.randint(0, 4)):
+                p = rnd.randint(0, len(b))
+                b[p:p + rnd.randint(0, 3)] = [rnd.choice('abxy') + '\n'
+                                              for x in xrange(rnd.randint(0, 3))]
+            if b and rnd.random() < 0.2:
+                b[-1] = b[-1][:-1]
+            original, new = ''.join(a), ''.join(b)
+            context = rnd.choice([0, 1, 3])
+            the_patch = make_patch(original, new, context)
+            if original == new:
+                self.assertEqual(the_patch, '')
+                continue
+            self.assertEqual(apply_patch(the_patch, original), new)
+            self.assertEqual(apply_patch(the_patch, new, reverse=True),
+                             original)
+            self.assertEqual(compile_diff(original, new, context).apply(
+                original), new)
+
+    def test_lone_cr(self):
+        # lines only end at '\n', a lone '\r' is part of the line
+        original = 'a\rb\nc\nd\re\n'
+        new = 'a\rb\nx\nd\re\n'
+        the_patch = make_patch(original, new)
+        self.assertFalse('No newline' in the_patch)
+        self.assertEqual(apply_patch(the_patch, original), new)
+        self.assertEqual(compile_diff(original, new).apply(original), new)
+
+    def test_crlf(self):
+        original = 'a\r\nb\r\nc\r\n'
+        new = 'a\r\nx\r\nc\r\nd\n'
+        self.assertEqual(compile_diff(original, new).apply(original), new)
+        self.assertEqual(compile_diff(new, original).apply(new), original)
+
+    def test_rewritten(self):
+        # nothing in common: a single replace, without any search
+        original = ''.join('old %d\n' % x for x in xrange(4000))
+        new = ''.join('new %d\n' % x for x in xrange(4000))
+        self.assertEqual(mdiff.matchingblocks(original.splitlines(True),
+                                              new.splitlines(True)), [])
+        the_patch = make_patch(original, new)
+        self.assertEqual(the_patch.count('@@ -'), 1)
+        self.assertEqual(apply_patch(the_patch, original), new)
+
+    def test_cost_cutoff(self):
+        rnd = random.Random(5)
+        for trial in xrange(50):
+            a = [rnd.choice('abc') for x in xrange(rnd.randint(1, 40))]
+            b = [rnd.choice('abc') for x in xrange(rnd.randint(1, 40))]
+            x, y, u, v = mdiff._middlesnake(a, 0, len(a), b, 0, len(b), 1)
+            self.assertEqual(a[x:u], b[y:v])
+            self.assertTrue(0 <= x <= u <= len(a) and 0 <= y <= v <= len(b))
+            # either a snake or a split leaving less on both parts
+            self.assertTrue(u > x or 0 < x + y < len(a) + len(b))
+
+    def test_matchingblocks(self):
+        a = list('abcabba')
+        b = list('cbabac')
+        blocks = mdiff.matchingblocks(a, b)
+        for i, j, n in blocks:
+            self.assertEqual(a[i:i + n], b[j:j + n])
+        # Myers finds a longest common subsequence
+        self.assertEqual(sum(n for i, j, n in blocks), 4)
+
+    def test_hunks(self):
+        original = test1_data['original']
+        new = test1_data['expected']
+        gitpatches, files = mdiff.diffparsed(original, new)
+        hunks = files[0][2]
+        self.assertEqual([(h.starta, h.lena, h.startb, h.lenb)
+                          for h in hunks], [(1, 6, 1, 6)])
+        self.assertEqual(make_patch(original, new),
+                         '--- a\n+++ b\n' + ''.join(hunks[0].hunk))
+        targetfile = StringIO(original)
+        patch.applyparsed(patch.UIDummy(), gitpatches, files, targetfile, {})
+        self.assertEqual(targetfile.getvalue(), new)
+
+    def test_zero_context(self):
+        # "-2,0" inserts after line 2, as diff -U0 means it
+        the_patch = '--- a\n+++ b\n@@ -2,0 +3 @@\n+x\n'
+        self.assertEqual(apply_patch(the_patch, 'a\nb\nc\n'),
+                         'a\nb\nx\nc\n')
+        self.assertEqual(apply_patch_buffer(the_patch, 'a\nb\nc\n'),
+                         'a\nb\nx\nc\n')
+
+class ComposeTest(unittest.TestCase):
+    def test_chains(self):
+        rnd = random.Random(4)
+        for trial in xrange(300):
+            docs = [[rnd.choice('abcde') + '\n'
+                     for x in xrange(rnd.randint(0, 15))]]
+            for k in xrange(rnd.randint(2, 4)):
+                b = list(docs[-1])
+                for k in xrange(rnd.randint(1, 3)):
+                    p = rnd.randint(0, len(b))
+                    b[p:p + rnd.randint(0, 3)] = [
+                        rnd.choice('abxyz') + '\n'
+                        for x in xrange(rnd.randint(0, 3))]
+                docs.append(b)
+            texts = [''.join(d) for d in docs]
+            context = rnd.choice([0, 3])
+            patches = [make_patch(texts[k], texts[k + 1], context)
+                       for k in xrange(len(texts) - 1)]
+            patches = [p for p in patches if p]
+            if not patches:
+                continue
+            composed = compose_patches(patches)
+            if composed:
+                self.assertEqual(apply_patch(composed, texts[0]), texts[-1])
+            else:
+                self.assertEqual(texts[0], texts[-1])
+
+    def test_cancel(self):
+        original, new = test1_data['original'], test1_data['expected']
+        undo = compile_patch(make_patch(new, original))
+        self.assertEqual(compose_patches([test1_data['patch'], undo]), '')
+
+    def test_conflict(self):
+        first = '--- a\n+++ b\n@@ -2,1 +2,1 @@\n-b\n+x\n'
+        second = '--- a\n+++ b\n@@ -1,2 +1,2 @@\n a\n-b\n+y\n'
+        self.assertRaises(PatchConflict, compose_patches, [first, second])
+        second = '--- a\n+++ b\n@@ -1,2 +1,2 @@\n a\n-x\n+y\n'
+        self.assertEqual(apply_patch(compose_patches([first, second]),
+                                     'a\nb\nc\n'), 'a\ny\nc\n')
+
+class PlannedPatchTest(unittest.TestCase):
+    def shuffled(self, the_patch, seed):
+        # the hunks of the_patch, in random order
+        header, rest = the_patch.split('\n@@', 1)
+        hunks = ['@@' + h for h in rest.split('\n@@')]
+        hunks = [h.endswith('\n') and h or h + '\n' for h in hunks]
+        random.Random(seed).shuffle(hunks)
+        return header + '\n' + ''.join(hunks)
+
+    def test_unordered(self):
+        for kind in ('exact', 'offset', 'fuzz1', 'duplicates'):
+            the_patch, original, expected = bench.makeworkload(kind, 300,
+                                                               12, 2)
+            shuffled = self.shuffled(the_patch, 1)
+            self.assertNotEqual(shuffled, the_patch)
+            collected = stats.patchstats()
+            self.assertEqual(apply_patch(shuffled, original, collected),
+                             expected)
+            self.assertEqual(collected.results['failed'], 0)
+
+    def test_unordered_files(self):
+        out = apply_patch_files(shuffled_data['patch'],
+                                {'f': shuffled_data['original']}, workers=1)
+        self.assertEqual(out, {'f': shuffled_data['expected']})
+
+    def test_unordered_series(self):
+        self.assertEqual(apply_series([shuffled_data['patch']],
+                                      shuffled_data['original']),
+                         shuffled_data['expected'])
+
+    def test_unordered_batch(self):
+        result, = apply_batch([(shuffled_data['patch'],
+                                shuffled_data['original'])], workers=1)
+        self.assertEqual(result.status, 'ok')
+        self.assertEqual(result.output, shuffled_data['expected'])
+
+    def test_offsets_exact(self):
+        # every hunk applies where it says, whatever the order
+        the_patch, original, expected = bench.makeworkload('exact', 300,
+                                                           12, 2)
+        stats = check_patch(self.shuffled(the_patch, 2), original)
+        self.assertEqual(set(s.status() for s in stats), set(['exact']))
+
+    def test_overlap(self):
+        the_patch = ('--- a\n+++ b\n@@ -2,2 +2,2 @@\n b\n-c\n+x\n'
+                     '@@ -1,3 +1,3 @@\n a\n-b\n+y\n c\n')
+        gitpatches, files = patch.readpatch(patch.UIDummy(),
+                                            StringIO(the_patch))
+        hunks = files[0][2]
+        self.assertFalse(patch.hunksordered(hunks))
+        current_file = patch.patchfile(patch.UIDummy(), None,
+                                       StringIO('a\nb\nc\nd\n'), False)
+        self.assertEqual(current_file.applyplanned(hunks), [-1, 0])
+        self.assertEqual(current_file.rej, [hunks[0]])
+        self.assertEqual(current_file.getvalue(), 'a\ny\nc\nd\n')
+
+class LocateTest(unittest.TestCase):
+    def test_locatelines(self):
+        lines = list('abcabcab')
+        found = patch.locatelines(lines, [list('ab'), list('abc'), ['c'],
+                                          list('ba'), list('abcabcabc')])
+        self.assertEqual(found, [[0, 3, 6], [0, 3], [2, 5], [], []])
+
+    def test_drifted(self):
+        for kind in ('offset', 'fuzz1', 'duplicates'):
+            the_patch, original, expected = bench.makeworkload(kind, 400,
+                                                               20, 2)
+            plain = stats.patchstats()
+            located = stats.patchstats()
+            self.assertEqual(apply_patch(the_patch, original, plain),
+                             expected)
+            self.assertEqual(apply_patch(the_patch, original, located,
+                                         locate=True), expected)
+            self.assertEqual([(s.position, s.fuzz) for s in plain.applied],
+                             [(s.position, s.fuzz) for s in located.applied])
+
+    def test_no_index(self):
+        # hunks found by the scan need no line index
+        the_patch, original, expected = bench.makeworkload('offset', 400,
+                                                           20, 2)
+        gitpatches, files = patch.readpatch(patch.UIDummy(),
+                                            StringIO(the_patch))
+        targetfile = StringIO(original)
+        current_file = patch.patchfile(patch.UIDummy(), None, targetfile)
+        current_file.locate(files[0][2])
+        for h in files[0][2]:
+            self.assertEqual(current_file.apply(h), 0)
+        self.assertTrue(current_file.index.hash is None)
+        self.assertEqual(current_file.getvalue(), expected)
+
+    def test_added_lines(self):
+        # the second hunk only matches lines added by the first one
+        the_patch = ('--- a\n+++ b\n@@ -1,1 +1,2 @@\n a\n+b\n'
+                     '@@ -10,2 +11,3 @@\n a\n b\n+c\n')
+        self.assertEqual(apply_patch(the_patch, 'a\n', locate=True),
+                         'a\nb\nc\n')
+
+class TestLinesBenchmark(unittest.TestCase):
+    # a fuzz-heavy case: every hunk misses its stated position and its
+    # first line, a lone brace, has thousands of candidates; timings
+    # are left to bench.comparetests()
+    def test_fuzzy_candidates(self):
+        original = ''.join('block %d\n\n{\n}\n\n' % x for x in xrange(2000))
+        target = original.splitlines(True)
+        hunks = patch.compiledpatch(fuzzy_patch).files[0][2]
+        index = patch.lineindex(target)
+
+        class countedlist(list):
+            # counts the reads from the target, a slice is one read
+            reads = 0
+            def __getitem__(self, i):
+                countedlist.reads += 1
+                return list.__getitem__(self, i)
+            def __getslice__(self, i, j):
+                countedlist.reads += 1
+                return list.__getslice__(self, i, j)
+        counted = countedlist(target)
+
+        def run(test, old, cands):
+            countedlist.reads = 0
+            found = [c for c in cands if test(old, counted, c) == 0]
+            return countedlist.reads, found
+
+        for h in hunks:
+            old = h.oldtext(1)
+            cands = [c for c in index.positions(old[0])
+                     if c + len(old) <= len(target)]
+            before, found_before = run(diffhelpers.testhunk, h.old(1), cands)
+            after, found_after = run(diffhelpers.testlines, old, cands)
+            self.assertEqual(found_before, found_after)
+            self.assertEqual(found_after, [7497])
+            # one read per candidate, where testhunk reads every line
+            # up to the first one that differs, here the last one
+            self.assertEqual(after, len(cands))
+            self.assertEqual(before, len(old) * after)
+
+    def test_compare_tests(self):
+        report = bench.comparetests(blocks=20, repeat=1)
+        self.assertEqual(report['candidates'], 40)
+
+    def test_fuzzy_patch(self):
+        original = ''.join('block %d\n\n{\n}\n\n' % x for x in xrange(2000))
+        collected = stats.patchstats()
+        out = apply_patch(fuzzy_patch, original, collected)
+        self.assertTrue('block 1500\nchanged\n' in out)
+        # anchored on 'block 1500', not on the blank first line
+        self.assertEqual(collected.candidates, 1)
+
+class StreamingPatchTest(unittest.TestCase):
+    def _do_test(self, original, patch, expected):
+        out = iter_patch(patch, StringIO(original))
+        self.assertEqual(''.join(out), expected)
+
+    def test_simple_patch(self):
+        self._do_test(**test1_data)
+
+    def test_offset_patch(self):
+        self._do_test(**test2_data)
+
+    def test_offset_hunks(self):
+        self._do_test(**offsets_data)
+
+    def test_chunks(self):
+        original = ''.join('line %d\n' % x for x in xrange(1, 5001))
+        out = list(patch.iterpatched(patch.UIDummy(),
+            compile_patch(offsets_data['patch']).files[0][2],
+            original.splitlines(True), chunklines=100))
+        self.assertTrue(max(len(c.splitlines()) for c in out) <= 100)
+        self.assertEqual(''.join(out), apply_patch(offsets_data['patch'],
+                                                   original))
+
+    def test_outside_window(self):
+        original = test2_data['original'].splitlines(True)
+        out = iter_patch(test2_data['patch'], original, window=1)
+        self.assertRaises(PatchError, list, out)
+
+class BufferPatchTest(unittest.TestCase):
+    def _do_test(self, original, patch, expected):
+        self.assertEqual(apply_patch_buffer(patch, original), expected)
+
+    def test_simple_patch(self):
+        self._do_test(**test1_data)
+
+    def test_offset_patch(self):
+        self._do_test(**test2_data)
+
+    def test_offset_hunks(self):
+        self._do_test(**offsets_data)
+
+    def test_stated_position_first(self):
+        # without trailing context, the search would start at the end
+        the_patch = '--- a\n+++ b\n@@ -1 +1,3 @@\n a\n+y\n+z\n'
+        self.assertEqual(apply_patch(the_patch, 'a\na\n'), 'a\ny\nz\na\n')
+        self._do_test('a\na\n', the_patch, 'a\ny\nz\na\n')
+
+    def test_memoryview(self):
+        out = StringIO()
+        apply_patch_buffer(test2_data['patch'],
+                           memoryview(test2_data['original']), out)
+        self.assertEqual(out.getvalue(), test2_data['expected'])
+
+    def test_mmap(self):
+        fp = tempfile.TemporaryFile()
+        try:
+            fp.write(offsets_data['original'])
+            fp.flush()
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                out = apply_patch_buffer(offsets_data['patch'], buf)
+                self.assertEqual(out, offsets_data['expected'])
+            finally:
+                buf.close()
+        finally:
+            fp.close()
+
+    def test_partial_lines(self):
+        # the first match starts inside a line and must be skipped
+        original = 'xline 1\nline 2\nline 1\nline 2\n'
+        the_patch = '--- a\n+++ b\n@@ -1,2 +1,2 @@\n line 1\n-line 2\n+two\n'
+        self.assertEqual(apply_patch_buffer(the_patch, original),
+                         'xline 1\nline 2\nline 1\ntwo\n')
+
+    def test_failed_hunk(self):
+        self.assertRaises(PatchError, apply_patch_buffer,
+                          test2_data['patch'], 'nothing\n')
+
+class BenchWorkloadTest(unittest.TestCase):
+    def test_workloads_apply(self):
+        for kind in bench.KINDS:
+            the_patch, original, expected = bench.makeworkload(kind, 200,
+                                                               10, 2)
+            self.assertEqual(apply_patch(the_patch, original), expected)
+
+    def test_record(self):
+        record = bench.runworkload(('fuzz1', 100, 5, 1, 1))
+        self.assertEqual(record['hunks'], 5)
+        self.assertTrue(record['apply_seconds'] > 0)
+
+class StatsTest(unittest.TestCase):
+    def test_offset_hunks(self):
+        patch.hunkcache.clear()
+        collected = stats.patchstats()
+        self.assertEqual(apply_patch(offsets_data['patch'],
+                                     offsets_data['original'], collected),
+                         offsets_data['expected'])
+        self.assertEqual(collected.hunksparsed, 2)
+        first, second = collected.applied
+        self.assertEqual((first.fastpath, first.status(), first.offset,
+                          first.position), (False, 'offset', 3, 5))
+        self.assertTrue(first.candidates >= 1)
+        self.assertEqual((second.status(), second.offset), ('offset', 5))
+        summary = collected.summary()
+        self.assertEqual((summary['offset'], summary['max_offset']), (2, 5))
+
+    def test_fuzz_and_failure(self):
+        collected = stats.patchstats()
+        the_patch, original, expected = bench.makeworkload('fuzz1', 50, 2, 1)
+        apply_patch(the_patch, original, collected)
+        self.assertEqual([s.fuzz for s in collected.applied], [1, 1])
+        self.assertRaises(PatchError, apply_patch,
+                          test2_data['patch'], 'unrelated\n', collected)
+        self.assertEqual(collected.applied[-1].status(), 'failed')
+        self.assertEqual(collected.results['failed'], 1)
+
+    def test_prometheus(self):
+        collected = stats.patchstats(keep=False)
+        apply_patch(test1_data['patch'], test1_data['original'], collected)
+        text = collected.prometheus()
+        self.assertTrue('hgpatcher_hunks_applied_total{result="exact"} 1\n'
+                        in text)
+        self.assertTrue('# TYPE hgpatcher_parse_seconds_total counter\n'
+                        in text)
+        self.assertEqual(collected.applied, [])
+
+class BackgroundPatchTest(unittest.TestCase):
+    def test_result(self):
+        pending = apply_patch_async(test2_data['patch'],
+                                    test2_data['original'])
+        self.assertEqual(pending.result(5), test2_data['expected'])
+        self.assertTrue(pending.done())
+
+    def test_callback_and_errors(self):
+        executor = background.patchexecutor(workers=1)
+        try:
+            done = []
+            pending = executor.submit(test2_data['patch'], 'unrelated\n')
+            pending.add_done_callback(done.append)
+            self.assertRaises(PatchError, pending.result, 5)
+            self.assertEqual(done, [pending])
+            self.assertTrue(isinstance(pending.exception(), PatchError))
+        finally:
+            executor.shutdown()
+
+    def test_cancel_and_timeout(self):
+        executor = background.patchexecutor(workers=1)
+        gate = threading.Event()
+
+        class gatejob(background.pendingpatch):
+            # holds the only worker until the gate opens
+            def start(self):
+                gate.wait()
+                return False
+
+        try:
+            executor.submit(test1_data['patch'], test1_data['original'])
+            executor._queue.put(gatejob(None, None))
+            queued = executor.submit(test2_data['patch'],
+                                     test2_data['original'])
+            expired = executor.submit(test2_data['patch'],
+                                      test2_data['original'], timeout=0)
+            cancelled = executor.submit(test2_data['patch'],
+                                        test2_data['original'])
+            self.assertTrue(cancelled.cancel())
+            self.assertTrue(cancelled.cancelled())
+            self.assertRaises(patch.PatchCancelled, cancelled.result)
+            self.assertRaises(patch.PatchTimeout, expired.result)
+            self.assertFalse(queued.done())
+            gate.set()
+            self.assertEqual(queued.result(5), test2_data['expected'])
+        finally:
+            gate.set()
+            executor.shutdown()
+
+    def test_cancel_running(self):
+        running = background.pendingpatch(test2_data['patch'],
+                                          test2_data['original'])
+        self.assertTrue(running.start())
+        self.assertTrue(running.cancel())
+        self.assertRaises(patch.PatchCancelled, running.check)
+        # whatever it still gives is dropped
+        running._finish('result', None)
+        self.assertTrue(running.cancelled())
+        self.assertRaises(patch.PatchCancelled, running.result)
+
+    def test_processes(self):
+        executor = background.patchexecutor(workers=2, processes=True)
+        try:
+            pending = executor.submit(test1_data['patch'],
+                                      test1_data['original'])
+            failing = executor.submit(test1_data['patch'], 'unrelated\n')
+            self.assertEqual(pending.result(30), test1_data['expected'])
+            self.assertRaises(PatchError, failing.result, 30)
+        finally:
+            executor.shutdown()
+        # the same failure, as a batch item
+        result, = apply_batch([(test1_data['patch'], 'unrelated\n')],
+                              workers=2)
+        self.assertEqual((result.status, result.output, result.rejects),
+                         ('rejected', None, [1]))
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        fuzzy = bench.makeworkload('fuzz1', 50, 2, 1)
+        self.pairs = [
+            (test1_data['patch'], test1_data['original']),
+            (test2_data['patch'], 'unrelated\n'),
+            ('not a patch\n', 'text\n'),
+            fuzzy[:2],
+            (test2_data['patch'], test2_data['original']),
+        ]
+
+    def _check(self, results):
+        results.sort(key=lambda r: r.index)
+        self.assertEqual([r.status for r in results],
+                         ['ok', 'rejected', 'error', 'fuzz', 'ok'])
+        self.assertEqual(results[0].output, test1_data['expected'])
+        self.assertEqual(results[1].rejects, [1])
+        self.assertEqual(results[2].error, 'NoHunks')
+        self.assertEqual(results[4].output, test2_data['expected'])
+
+    def test_in_process(self):
+        self._check(list(apply_batch(self.pairs, workers=1)))
+
+    def test_ordered(self):
+        results = list(apply_batch(self.pairs, workers=2, chunksize=2))
+        self.assertEqual([r.index for r in results], range(5))
+        self._check(results)
+
+    def test_unordered(self):
+        self._check(list(apply_batch(self.pairs, workers=2, chunksize=1,
+                                     ordered=False)))
+
+class CheckPatchTest(unittest.TestCase):
+    def test_exact(self):
+        stats = check_patch(test1_data['patch'], test1_data['original'])
+        self.assertEqual([s.status() for s in stats], ['exact'])
+        self.assertEqual(stats[0].position, 1)
+
+    def test_offsets(self):
+        original = offsets_data['original']
+        stats = check_patch(offsets_data['patch'], original)
+        self.assertEqual([s.status() for s in stats],
+                         [s.status() for s in self.applied(offsets_data)])
+        self.assertEqual(original, offsets_data['original'])
+
+    def test_fuzz_and_failure(self):
+        the_patch, original, expected = bench.makeworkload('fuzz1', 50, 2, 1)
+        stats = check_patch(the_patch, original)
+        self.assertEqual([s.fuzz for s in stats], [1, 1])
+        self.assertEqual([s.position for s in stats],
+                         [s.position for s in self.applied(
+                             {'patch': the_patch, 'original': original})])
+        stats = check_patch(test2_data['patch'], test1_data['original'])
+        self.assertEqual(set(s.status() for s in stats), set(['failed']))
+        self.assertEqual(stats[0].position, None)
+
+    def test_reverse(self):
+        stats = check_patch(test1_data['patch'], test1_data['expected'],
+                            reverse=True)
+        self.assertEqual([s.status() for s in stats], ['exact'])
+
+    def applied(self, data):
+        collected = stats.patchstats()
+        apply_patch(data['patch'], data['original'], collected)
+        return collected.applied
+
+class EolTest(unittest.TestCase):
+    def test_crlf(self):
+        the_patch, original, expected = bench.makeworkload('crlf', 200, 5, 2)
+        self.assertEqual(apply_patch(the_patch, original), expected)
+        self.assertEqual(apply_patch(the_patch, original, eol='\r\n'),
+                         expected.replace('\n', '\r\n'))
+        self.assertEqual(apply_patch(the_patch, original, eol='keep'),
+                         expected.replace('\n', '\r\n'))
+        crlf_patch = the_patch.replace('\n', '\r\n')
+        self.assertEqual(apply_patch(crlf_patch, original), expected)
+
+    def test_keep_mixed(self):
+        original = 'a\r\nb\nc\r\nd\r\ne\n'
+        the_patch = ('--- a\n+++ b\n@@ -2,3 +2,3 @@\n b\n-c\n+x\n d\n')
+        self.assertEqual(apply_patch(the_patch, original, eol='keep'),
+                         'a\r\nb\nx\r\nd\r\ne\n')
+        the_patch = ('--- a\n+++ b\n@@ -4,2 +4,2 @@\n d\n-e\n+y\n')
+        self.assertEqual(apply_patch(the_patch, original, eol='keep'),
+                         'a\r\nb\nc\r\nd\r\ny\r\n')
+
+    def test_eolinfo(self):
+        self.assertEqual(patch.eolinfo('a\nb\n'), ('\n', None))
+        self.assertEqual(patch.eolinfo('a\r\nb'), ('\r\n', None))
+        self.assertEqual(patch.eolinfo('a\nb\r\nc\n'),
+                         ('\n', bytearray([0, 1, 0])))
+        self.assertEqual(patch.splitlines('a\rb\nc'), ['a\rb\n', 'c'])
+        self.assertEqual(patch.splitlines(u'a\rb\n'), [u'a\rb\n'])
+
+class ReversePatchTest(unittest.TestCase):
+    def test_reverse(self):
+        for data in (test1_data, test2_data, offsets_data):
+            self.assertEqual(apply_patch(data['patch'], data['expected'],
+                                         reverse=True), data['original'])
+
+    def test_reverse_no_newline(self):
+        the_patch = ('--- a\n+++ b\n@@ -1,2 +1,2 @@\n one\n-two\n'
+                     '\\ No newline at end of file\n+three\n'
+                     '\\ No newline at end of file\n')
+        self.assertEqual(apply_patch(the_patch, 'one\ntwo'), 'one\nthree')
+        self.assertEqual(apply_patch(the_patch, 'one\nthree', reverse=True),
+                         'one\ntwo')
+
+    def test_reverse_create(self):
+        create = '--- /dev/null\n+++ b/new\n@@ -0,0 +1,2 @@\n+a\n+b\n'
+        delete = '--- a/new\n+++ /dev/null\n@@ -1,2 +0,0 @@\n-a\n-b\n'
+        self.assertEqual(apply_patch(create, ''), 'a\nb\n')
+        self.assertEqual(apply_patch(create, 'a\nb\n', reverse=True), '')
+        self.assertEqual(apply_patch(delete, 'a\nb\n'), '')
+        self.assertEqual(apply_patch(delete, '', reverse=True), 'a\nb\n')
+
+    def test_cache(self):
+        # forward and reverse parses are cached apart
+        the_patch = test1_data['patch']
+        for x in xrange(2):
+            self.assertEqual(apply_patch(the_patch, test1_data['original']),
+                             test1_data['expected'])
+            self.assertEqual(apply_patch(the_patch, test1_data['expected'],
+                                         reverse=True),
+                             test1_data['original'])
+
+    def test_binary(self):
+        self.assertRaises(PatchError, patch.readpatch, patch.UIDummy(),
+                          StringIO(binary_patch), reverse=True)
+
+class SeriesTest(unittest.TestCase):
+    def test_series(self):
+        # test1 applied, reverted and applied again
+        revert = ('--- 2\n+++ 1\n@@ -1,6 +1,6 @@\n some text\n'
+                  '+with important initial\n+information that is going\n'
+                  ' to be changed by a\n-information that is going\n'
+                  ' patch in the form of a unified\n diff.\n'
+                  '-with important initial\n')
+        checkpoints = dict.fromkeys([0, 1])
+        out = apply_series([test1_data['patch'], compile_patch(revert),
+                            test1_data['patch']],
+                           test1_data['original'], checkpoints)
+        self.assertEqual(out, test1_data['expected'])
+        self.assertEqual(checkpoints, {0: test1_data['expected'],
+                                       1: test1_data['original']})
+
+    def test_growing_document(self):
+        # every patch appends a line after the one the previous added
+        patches = []
+        for x in xrange(1, 50):
+            patches.append('--- a\n+++ b\n@@ -%d,1 +%d,2 @@\n line %d\n'
+                           '+line %d\n' % (x, x, x - 1, x))
+        out = apply_series(patches, 'line 0\n')
+        self.assertEqual(out, ''.join('line %d\n' % x for x in xrange(50)))
+
+    def test_failure(self):
+        self.assertRaises(PatchError, apply_series,
+                          [test1_data['patch'], test2_data['patch']],
+                          test1_data['original'])
+
+class CompiledPatchTest(unittest.TestCase):
+    def test_apply(self):
+        compiled = compile_patch(test2_data['patch'])
+        self.assertEqual(compiled.apply(test2_data['original']),
+                         test2_data['expected'])
+
+    def test_apply_many(self):
+        compiled = compile_patch(test2_data['patch'])
+        shifted = 'x\n' + test2_data['original']
+        out = list(compiled.apply_many([test2_data['original'], shifted]))
+        self.assertEqual(out, [test2_data['expected'],
+                               'x\n' + test2_data['expected']])
+
+    def test_apply_files(self):
+        compiled = compile_patch(multi_data['patch'])
+        out = compiled.apply_files(multi_data['files'], workers=1)
+        self.assertEqual(out, multi_data['expected'])
+
+    def test_apply_files_immutable(self):
+        compiled = compile_patch('--- a/new.txt\n+++ b/new.txt\n'
+                                 '@@ -0,0 +1,1 @@\n+hello\n')
+        self.assertEqual(compiled.apply('existing\n'), 'hello\nexisting\n')
+        self.assertEqual(compiled.apply_files({}, workers=1),
+                         {'new.txt': 'hello\n'})
+        self.assertEqual(compiled.apply('existing\n'), 'hello\nexisting\n')
+
+class ParseCacheTest(unittest.TestCase):
+    def test_apply_patch_hits(self):
+        patch.hunkcache.clear()
+        for i in range(3):
+            self._check_apply(test2_data)
+        self.assertEqual(patch.hunkcache.misses, 1)
+        self.assertEqual(patch.hunkcache.hits, 2)
+
+    def _check_apply(self, data):
+        self.assertEqual(apply_patch(data['patch'], data['original']),
+                         data['expected'])
+
+    def test_entry_eviction(self):
+        cache = patch.parsecache(maxentries=1)
+        ui = patch.UIDummy()
+        cache.readpatch(ui, test1_data['patch'])
+        cache.readpatch(ui, test2_data['patch'])
+        cache.readpatch(ui, test1_data['patch'])
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 3, 1))
+
+    def test_size_eviction(self):
+        size = len(test1_data['patch']) + len(test2_data['patch'])
+        cache = patch.parsecache(maxsize=size - 1)
+        ui = patch.UIDummy()
+        cache.readpatch(ui, test1_data['patch'])
+        cache.readpatch(ui, test2_data['patch'])
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, len(test2_data['patch']))
+        cache.readpatch(ui, test2_data['patch'])
+        self.assertEqual(cache.hits, 1)
+
+    def test_disabled(self):
+        cache = patch.parsecache(maxentries=0)
+        ui = patch.UIDummy()
+        cache.readpatch(ui, test1_data['patch'])
+        cache.readpatch(ui, test1_data['patch'])
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 0, 0))
+
+class BinaryPatchTest(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(3)
+        self.blob = ''.join(chr(rnd.randint(0, 255)) for x in xrange(3000))
+        self.files = {
+            'blob.bin': self.blob,
+            'new.bin': '\x00\x01\x02hello\xff\r\n',
+        }
+
+    def test_literal_and_delta(self):
+        out = apply_patch_files(binary_patch, self.files, workers=1)
+        self.assertEqual(out, {
+            'blob.bin': self.blob[:1000] + 'INSERTED\0\0' + self.blob[1200:],
+            'new.bin': '\x00\x01\x02hello\xfe\r\n',
+        })
+
+    def test_buffer(self):
+        the_patch = binary_patch[binary_patch.index('diff --git a/new.bin'):]
+        out = apply_patch_buffer(the_patch, self.files['new.bin'])
+        self.assertEqual(out, '\x00\x01\x02hello\xfe\r\n')
+
+    def test_wrong_source(self):
+        self.files['blob.bin'] = self.blob[1:]
+        self.assertRaises(PatchError, apply_patch_files, binary_patch,
+                          self.files, workers=1)
+
+    def test_bindelta(self):
+        source = 'abcdefghij' * 3
+        # source and result sizes, copy 5 bytes from offset 10, insert 'XY'
+        delta = '\x1e\x07\x91\x0a\x05\x02XY'
+        pieces = [delta[x:x + 3] for x in xrange(0, len(delta), 3)]
+        self.assertEqual(patch.applybindelta(pieces, source), 'abcdeXY')
+
+class PatchFilesTest(unittest.TestCase):
+    def test_multiple_files(self):
+        out = apply_patch_files(multi_data['patch'], multi_data['files'],
+                                workers=1)
+        self.assertEqual(out, multi_data['expected'])
+
+    def test_thread_pool(self):
+        pool = ThreadPool(2)
+        try:
+            out = apply_patch_files(multi_data['patch'],
+                                    multi_data['files'], pool=pool)
+        finally:
+            pool.close()
+        self.assertEqual(out, multi_data['expected'])
+
+    def test_process_pool(self):
+        out = apply_patch_files(multi_data['patch'], multi_data['files'],
+                                workers=2)
+        self.assertEqual(out, multi_data['expected'])
+
+    def test_original_untouched(self):
+        files = dict(multi_data['files'])
+        apply_patch_files(multi_data['patch'], files, workers=1)
+        self.assertEqual(files, multi_data['files'])
+
+    def test_missing_file(self):
+        files = dict(multi_data['files'])
+        del files['one.txt']
+        self.assertRaises(PatchError, apply_patch_files,
+                          multi_data['patch'], files, workers=1)
+
+    def test_delete_single_text(self):
+        # outside a file map, a removed file is an empty text
+        the_patch = '--- a\n+++ /dev/null\n@@ -1,2 +0,0 @@\n-a\n-b\n'
+        self.assertEqual(apply_patch(the_patch, 'a\nb\n'), '')
+        self.assertEqual(compile_patch(the_patch).apply('a\nb\n'), '')
+        self.assertEqual(apply_series([the_patch], 'a\nb\n'), '')
+        result, = apply_batch([(the_patch, 'a\nb\n')], workers=1)
+        self.assertEqual((result.status, result.output), ('ok', ''))
+        self.assertEqual(apply_patch_files(the_patch, {'a': 'a\nb\n'},
+                                           strip=0, workers=1), {})
+
+    def test_mode_change_last(self):
+        # a last section without hunks is no patch without hunks
+        the_patch = ('diff --git a/one.txt b/one.txt\n--- a/one.txt\n'
+                     '+++ b/one.txt\n@@ -1,1 +1,1 @@\n-a\n+b\n'
+                     'diff --git a/two.txt b/two.txt\n'
+                     'old mode 100644\nnew mode 100755\n')
+        out = apply_patch_files(the_patch, {'one.txt': 'a\n',
+                                            'two.txt': 'x\n'}, workers=1)
+        self.assertEqual(out, {'one.txt': 'b\n', 'two.txt': 'x\n'})
+
+    def test_shared_hunks_untouched(self):
+        # a create patch whose afile is not /dev/null: picking the file
+        # must not change the cached hunks apply_patch() gets later
+        the_patch = '--- a/new.txt\n+++ b/new.txt\n@@ -0,0 +1,1 @@\n+hello\n'
+        self.assertEqual(apply_patch(the_patch, 'existing\n'),
+                         'hello\nexisting\n')
+        self.assertEqual(apply_patch_files(the_patch, {}, workers=1),
+                         {'new.txt': 'hello\n'})
+        self.assertEqual(apply_patch(the_patch, 'existing\n'),
+                         'hello\nexisting\n')
+
+    def test_rename_then_copy(self):
+        # the copy reads 'a' as it was before the rename and the change
+        out = apply_patch_files(gitcopy_data['patch'], gitcopy_data['files'],
+                                workers=1)
+        self.assertEqual(out, gitcopy_data['expected'])
+
+    def test_git_metadata(self):
+        events = list(patch.iterhunks(patch.UIDummy(),
+                                      StringIO(gitcopy_data['patch'])))
+        self.assertEqual(events[-1][0], 'git')
+        self.assertEqual([(gp.op, gp.oldpath, gp.path)
+                          for gp in events[-1][1]],
+                         [('RENAME', 'a', 'b'), ('COPY', 'a', 'c')])
+        lines = gitcopy_data['patch'].splitlines()
+        for gp in events[-1][1]:
+            self.assertTrue(lines[gp.lineno - 1].startswith('diff --git'))
+        self.assertEqual([gp.lineno for gp in events[-1][1]], [1, 10])
+
 test1_data = {
 'original': """\
 some text
@@ -91,3 +1001,168 @@ c
 11
 """,
 }
+
+multi_data = {
+'files': {
+    'one.txt': test1_data['original'],
+    'two.txt': test2_data['original'],
+    'gone.txt': "bye\n",
+    'moved.txt': "same\n",
+},
+
+'patch': """\
+diff --git a/one.txt b/one.txt
+--- a/one.txt
++++ b/one.txt
+@@ -1,6 +1,6 @@
+ some text
+-with important initial
+-information that is going
+ to be changed by a
++information that is going
+ patch in the form of a unified
+ diff.
++with important initial
+diff --git a/two.txt b/two.txt
+--- a/two.txt
++++ b/two.txt
+@@ -6,6 +6,4 @@
+ 6
+ 7
+ 8
+-9
+-10
+ 11
+diff --git a/gone.txt b/gone.txt
+deleted file mode 100644
+--- a/gone.txt
++++ /dev/null
+@@ -1,1 +0,0 @@
+-bye
+diff --git a/new.txt b/new.txt
+new file mode 100644
+--- /dev/null
++++ b/new.txt
+@@ -0,0 +1,2 @@
++hello
++world
+diff --git a/moved.txt b/renamed.txt
+rename from moved.txt
+rename to renamed.txt
+""",
+
+'expected': {
+    'one.txt': test1_data['expected'],
+    'two.txt': test2_data['expected'],
+    'new.txt': "hello\nworld\n",
+    'renamed.txt': "same\n",
+},
+}
+
+gitcopy_data = {
+'files': {'a': "one\ntwo\n"},
+
+'patch': """\
+diff --git a/a b/b
+rename from a
+rename to b
+--- a/a
++++ b/b
+@@ -1,2 +1,2 @@
+ one
+-two
++two in b
+diff --git a/a b/c
+copy from a
+copy to c
+--- a/a
++++ b/c
+@@ -1,2 +1,2 @@
+-one
++one in c
+ two
+""",
+
+'expected': {'b': "one\ntwo in b\n", 'c': "one in c\ntwo\n"},
+}
+
+# hunks out of order, applying them one by one finds a wrong 'y z y'
+shuffled_data = {
+'original': 'x\ny\ny\ny\ny\nx\nx\nz\nx\nx\nz\ny\nz\ny\ny\nx\ny\nz\ny\nz\n',
+
+'patch': """\
+--- a/f
++++ b/f
+@@ -17,3 +20,2 @@
+ y
+-z
+ y
+@@ -13,2 +13,5 @@
+ z
++z
++z
++z
+ y
+""",
+
+'expected': ('x\ny\ny\ny\ny\nx\nx\nz\nx\nx\nz\ny\nz\nz\nz\nz\ny\ny\nx\ny\ny'
+             '\nz\n'),
+}
+
+offsets_data = {
+'original': ''.join('line %d\n' % x for x in xrange(1, 41)),
+
+'patch': """\
+--- a   2010-01-15 15:08:03.000000000 +0200
++++ b   2010-01-15 15:08:11.000000000 +0200
+@@ -2,3 +2,4 @@
+ line 5
+ line 6
++new a
+ line 7
+@@ -20,3 +21,2 @@
+ line 25
+-line 26
+ line 27
+""",
+
+'expected': ''.join('line %d\n' % x for x in xrange(1, 7)) + 'new a\n' +
+            ''.join('line %d\n' % x for x in xrange(7, 41) if x != 26),
+}
+
+fuzzy_patch = """\
+--- a   2010-01-15 15:08:03.000000000 +0200
++++ b   2010-01-15 15:08:11.000000000 +0200
+@@ -10,5 +10,6 @@
+ 
+ {
+ }
+ 
+ block 1500
++changed
+"""
+
+binary_patch = """\
+diff --git a/blob.bin b/blob.bin
+index a46dedab2c50a38c8b6b974f4d437e853cad8fd4..d9727e2eeeb35bb3a79113904c17d547cbdf4f3a 100644
+GIT binary patch
+delta 23
+ecmdlX{!4Vj3uZ1)zhKv(5LXulhRqvTIM@Mbtp`{D
+
+delta 214
+zcmV;{04e|a6}T6$=mUQ<4f<%`9RuFW{jY|^7m9EtnNopYQCpe&@7&c%`b8gryH}-1
+z_j7uP-~5Mho)K)=#}C?K`&~AS;%?ryTugyxU#8%dB{*K4BNS3d2Z`&5ywuj|aIPNV
+zV0q(7Fw&V72U!8tFGgd6ZlI`d82Ydkalri$0(xxZ(^PAf;xkEP7NiF6hLROKc-x6c
+z`>BUBOy(kpo?67{+q^UnZcj1aH`4GP>18%A34dbQ)edH3EkHxDR~$HTkUq0FtD7vq
+QWQv)faSqAcv+@H72ZaD=xc~qF
+
+diff --git a/new.bin b/new.bin
+index a7a60cd436ba1ead5e05b98ee0ff01ad44dc2002..8f2be94cdbae97e620ff0a4a7d4a3d5862ba30ac 100644
+GIT binary patch
+literal 11
+ScmZQzWXed*$;to6%LM=rr~@qk
+
+literal 11
+ScmZQzWXed*$;toE%LM=rs{<|o
+
+"""